@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*- \#
+"""
+plot many studies from a manifest in a pool of warm worker processes
+
+the manifest is tab separated, one study per line, with the columns:
+    profile  tax_ass  group  outdir  options
+group and options may be empty, options are passed to create_and_plot.py,
+lines starting with # are skipped, relative paths are relative to the manifest.
+"""
+
+from __future__ import division, print_function
+import os
+import sys
+import csv
+import shlex
+import argparse
+import threading
+import traceback
+import multiprocessing
+from timeit import default_timer as timer
+from collections import OrderedDict
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+MANIFEST_COLUMNS = ['profile', 'tax_ass', 'group', 'outdir', 'options']
+
+REQUIRED_COLUMNS = ['profile', 'tax_ass', 'outdir']
+
+
+def read_params(args):
+    parser = argparse.ArgumentParser(description='batch plot tax tree')
+    parser.add_argument('manifest', metavar='FILE', type=str,
+                        help="set the manifest of the studies to plot")
+    parser.add_argument('-p', '--processes', dest='processes', metavar='INT', type=int, default=1,
+                        help="plot the studies in a pool of INT processes, [default is 1]")
+    parser.add_argument('-r', '--report', dest='report', metavar='FILE', type=str, default=None,
+                        help="write the summary report to FILE, [default is batch_report.txt beside the manifest]")
+    args = parser.parse_args(args)
+    params = vars(args)
+    if params['report'] is None:
+        params['report'] = os.path.join(os.path.dirname(os.path.abspath(params['manifest'])), 'batch_report.txt')
+    return params
+
+
+def read_manifest(manifest):
+    """
+    Returns a list of OrderedDict, one per study of the manifest. A row without a profile, tax_ass or outdir,
+    or with the outdir of an earlier row, gets an error and is not plotted.
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest))
+    jobs = []
+    outdirs = {}
+    with open(manifest) as fp:
+        for line_num, row in enumerate(csv.reader(fp, delimiter='\t', quoting=csv.QUOTE_NONE), 1):
+            if not row or not row[0].strip() or row[0].startswith('#'):
+                continue
+            row = [col.strip() for col in row] + [''] * (len(MANIFEST_COLUMNS) - len(row))
+            job = OrderedDict(zip(MANIFEST_COLUMNS, row))
+            job['error'] = ''
+            missing = [key for key in REQUIRED_COLUMNS if not job[key]]
+            for key in ('profile', 'tax_ass', 'group', 'outdir'):
+                if job[key]:
+                    job[key] = os.path.normpath(os.path.join(base_dir, job[key]))
+            if missing:
+                job['error'] = 'line %d: no %s' % (line_num, ', '.join(missing))
+            elif job['outdir'] in outdirs:
+                job['error'] = 'line %d: the outdir of line %d' % (line_num, outdirs[job['outdir']])
+            else:
+                outdirs[job['outdir']] = line_num
+            jobs.append(job)
+    return jobs
+
+
+def job_args(job):
+    """
+    Returns the create_and_plot.py command line of a manifest row
+    """
+    args = ['--profile', job['profile'], '--tax_ass', job['tax_ass'], '-o', job['outdir']]
+    if job['group']:
+        args += ['-g', job['group']]
+    return args + shlex.split(job['options'])
+
+
+def init_worker():
+    # pay for ete3/Qt, pandas and numpy once per worker instead of once per study
+    import create_and_plot
+    create_and_plot.get_tree_style()
+
+
+def new_result(job):
+    return OrderedDict([('outdir', job['outdir']), ('status', 'ok'), ('total', 0),
+                        ('timings', OrderedDict()), ('error', '')])
+
+
+def failed_result(job, error):
+    result = new_result(job)
+    result['status'] = 'failed'
+    result['error'] = error
+    return result
+
+
+def run_job(job):
+    """
+    Plot one study, errors are caught and returned in the result instead of raised
+    """
+    import create_and_plot
+    result = new_result(job)
+    start = timer()
+    try:
+        params = create_and_plot.read_params(job_args(job))
+        # the worker is already a batch process, it may not start a pool of its own
+        params['processes'] = 1
+        result['timings'] = create_and_plot.run(params)
+    except SystemExit as e:
+        result['status'] = 'failed'
+        result['error'] = 'bad options: exit %s' % e.code
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc().strip().splitlines()[-1]
+    result['total'] = timer() - start
+    return result
+
+
+def worker_loop(conn):
+    """
+    Run the jobs received from conn until None is received, sending back the result of each
+    """
+    init_worker()
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        conn.send(run_job(job))
+
+
+class Worker(object):
+    """
+    A warm worker process plotting one job at a time. A job which kills the process, such as
+    a Qt abort or an out of memory kill, fails alone, and the process is started again.
+    """
+    POLL_INTERVAL = 1
+
+    def __init__(self):
+        self.__conn = None
+        self.__process = None
+        self.__start()
+
+    def __start(self):
+        self.__conn, child_conn = multiprocessing.Pipe()
+        self.__process = multiprocessing.Process(target=worker_loop, args=(child_conn,))
+        self.__process.daemon = True
+        self.__process.start()
+        child_conn.close()
+
+    def run(self, job):
+        start = timer()
+        try:
+            self.__conn.send(job)
+            while True:
+                if self.__conn.poll(self.POLL_INTERVAL):
+                    return self.__conn.recv()
+                if not self.__process.is_alive() and not self.__conn.poll():
+                    break
+        except (EOFError, IOError, OSError):
+            pass
+        self.__process.join()
+        result = failed_result(job, 'worker died: exit %s' % self.__process.exitcode)
+        result['total'] = timer() - start
+        self.__start()
+        return result
+
+    def close(self):
+        try:
+            self.__conn.send(None)
+        except (IOError, OSError):
+            pass
+        self.__process.join()
+
+
+def write_report(results, outfile):
+    stages = []
+    for result in results:
+        stages.extend(name for name in result['timings'] if name not in stages)
+    with open(outfile, 'w') as out:
+        out.write('\t'.join(['outdir', 'status', 'total'] + stages + ['error']) + '\n')
+        for result in results:
+            line = [result['outdir'], result['status'], '%.3f' % result['total']]
+            line += ['%.3f' % result['timings'][name] if name in result['timings'] else '' for name in stages]
+            out.write('\t'.join(line + [result['error']]) + '\n')
+
+
+def run_batch(jobs, processes=1):
+    """
+    Plot every job in ``processes`` worker processes, returns the results in the order of the jobs.
+    The jobs with an error from the manifest are failed without being run.
+    """
+    results = [failed_result(job, job['error']) if job['error'] else None for job in jobs]
+    todo = Queue.Queue()
+    for ind, job in enumerate(jobs):
+        if not job['error']:
+            todo.put(ind)
+
+    def feed():
+        worker = Worker()
+        try:
+            while True:
+                try:
+                    ind = todo.get_nowait()
+                except Queue.Empty:
+                    break
+                results[ind] = worker.run(jobs[ind])
+        finally:
+            worker.close()
+
+    threads = [threading.Thread(target=feed) for _ in range(min(max(processes, 1), todo.qsize()))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+if __name__ == '__main__':
+    params = read_params(sys.argv[1:])
+    jobs = read_manifest(params['manifest'])
+    results = run_batch(jobs, params['processes'])
+    write_report(results, params['report'])
+    failed = [result for result in results if result['status'] != 'ok']
+    for result in failed:
+        print('failed: %s: %s' % (result['outdir'], result['error']), file=sys.stderr)
+    print('%d of %d studies plotted, report in %s' % (len(results) - len(failed), len(results), params['report']),
+          file=sys.stderr)
+    sys.exit(1 if failed else 0)
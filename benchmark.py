@@ -0,0 +1,607 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*- \#
+"""
+benchmarks of the tree and profile code on synthetic data
+"""
+
+from __future__ import division, print_function
+import os
+import sys
+import time
+import types
+import tempfile
+import random
+import argparse
+import subprocess
+from timeit import default_timer as timer
+from collections import OrderedDict
+from tree import Tree as TaxTree
+from tree import TreeNode as Node
+
+LEVEL_PREFIX = ['k', 'p', 'c', 'o', 'f', 'g', 's']
+
+
+def read_params(args):
+    parser = argparse.ArgumentParser(description='benchmark tax tree')
+    parser.add_argument('names', metavar='NAME', nargs='*', default=list(BENCHMARKS),
+                        help="set the benchmarks to run, [default is all of %s]" % ', '.join(BENCHMARKS))
+    parser.add_argument('-n', '--nodes', dest='nodes', metavar='INT', type=int, default=100000,
+                        help="set the node num of synthetic trees, [default is 100000]")
+    parser.add_argument('--otus', dest='otus', metavar='INT', type=int, default=100000,
+                        help="set the otu num of synthetic profiles, [default is 100000]")
+    parser.add_argument('--samples', dest='samples', metavar='INT', type=int, default=500,
+                        help="set the sample num of synthetic profiles, [default is 500]")
+    parser.add_argument('--seed', dest='seed', metavar='INT', type=int, default=0,
+                        help="set the random seed, [default is 0]")
+    parser.add_argument('--scales', dest='scales', metavar='STR', type=str, default='1000,10000,100000,1000000',
+                        help="set the comma separated otu nums of the scaling benchmark, "
+                             "[default is 1000,10000,100000,1000000]")
+    parser.add_argument('--scale_samples', dest='scale_samples', metavar='INT', type=int, default=50,
+                        help="set the sample num of the scaling benchmark, [default is 50]")
+    parser.add_argument('--depth', dest='depth', metavar='INT', type=int, default=6,
+                        help="set the rank num of the synthetic lineages, at most 7, [default is 6]")
+    parser.add_argument('--skew', dest='skew', metavar='FLOAT', type=float, default=1.0,
+                        help="set the pareto shape of the branching and abundance, smaller is more skewed, "
+                             "[default is 1.0]")
+    parser.add_argument('--top', dest='top', metavar='INT', type=int, default=1000,
+                        help="set the top num of the scaling benchmark, [default is 1000]")
+    parser.add_argument('--render', dest='render', action='store_true',
+                        help="also time the render stages in the scaling benchmark, [default is false]")
+    parser.set_defaults(render=False)
+    parser.add_argument('--data_dir', dest='data_dir', metavar='DIR', type=str, default=None,
+                        help="keep the synthetic files in DIR and reuse them, [default is a temp dir]")
+    parser.add_argument('--save', dest='save', metavar='FILE', type=str, default=None,
+                        help="save the results as json to FILE, [default is not to save]")
+    parser.add_argument('--compare', dest='compare', metavar='FILE', type=str, default=None,
+                        help="print the results saved in FILE and the ratio to them beside the results, "
+                             "[default is not to compare]")
+    params = vars(parser.parse_args(args))
+    params['scales'] = [int(scale) for scale in params['scales'].split(',')]
+    return params
+
+
+def timed(fun, *args, **kwargs):
+    start = timer()
+    result = fun(*args, **kwargs)
+    return timer() - start, result
+
+
+def make_dict_node_class():
+    """
+    Returns a copy of TreeNode which keeps its attributes in a __dict__
+    instead of __slots__, as TreeNode did before.
+    """
+    attrs = dict((key, value) for key, value in vars(Node).items()
+                 if key != '__slots__' and not isinstance(value, types.MemberDescriptorType))
+    return type('DictTreeNode', (object,), attrs)
+
+
+def make_tree(nodes, seed=0, node_class=Node):
+    """
+    Build a random taxonomy tree of about ``nodes`` nodes. The branching is
+    skewed, so that a few parents get thousands of children.
+    """
+    rand = random.Random(seed)
+    tree = TaxTree(root=node_class('root', level='root'))
+    per_level = [max(1, int(nodes * 2 ** ind / 127)) for ind in range(len(LEVEL_PREFIX))]
+    parents = [tree.root]
+    for prefix, num in zip(LEVEL_PREFIX, per_level):
+        weights = [rand.paretovariate(1) for _ in parents]
+        total = sum(weights)
+        level_nodes = []
+        for parent, weight in zip(parents, weights):
+            for ind in range(max(1, int(round(num * weight / total)))):
+                node = node_class('%s__%s_%d' % (prefix, len(level_nodes), ind), level=prefix)
+                parent.add_child(node)
+                node.profile = rand.random()
+                tree.nodes[node.name] = node
+                level_nodes.append(node)
+        parents = level_nodes
+    return tree
+
+
+def legacy_adjust_profile(tree):
+    for node in tree:
+        if not node.get_sisters():
+            continue
+        percent = node.profile / sum(map(lambda s: s.profile, node.get_sisters(include=True)))
+        if node.up.profile:
+            node.profile = percent * node.up.profile
+        else:
+            node.profile = percent
+
+
+def max_diff(tree_a, tree_b):
+    return max(abs(a.profile - b.profile) / (abs(b.profile) or 1) for a, b in zip(tree_a, tree_b))
+
+
+def bench_adjust_profile(params):
+    results = OrderedDict()
+    tree = make_tree(params['nodes'], seed=params['seed'])
+    results['nodes'] = len(list(tree))
+    results['legacy'], _ = timed(legacy_adjust_profile, tree)
+    new_tree = make_tree(params['nodes'], seed=params['seed'])
+    results['adjust_profile'], _ = timed(new_tree.adjust_profile)
+    results['max_rel_diff'] = max_diff(new_tree, tree)
+    deferred_tree = make_tree(params['nodes'], seed=params['seed'])
+    results['adjust_profile_deferred'], _ = timed(deferred_tree.adjust_profile, refresh=False)
+    results['refresh_profile'], _ = timed(deferred_tree.refresh_profile)
+    return results
+
+
+def make_tax_lines(otus, seed=0, depth=6, skew=1.0):
+    """
+    Returns a Series of random qiime tax lines for ``otus`` otus, about 50 otus share a taxon of
+    the lowest rank. The lineages are ``depth`` ranks deep, from kingdom down.
+    Both the parent of each taxon and the abundance of the lowest taxa are drawn from a pareto
+    distribution of shape ``skew``, the smaller the more skewed.
+    """
+    import numpy as np
+    import pandas as pd
+    rand = np.random.RandomState(seed)
+    leaves = max(1, otus // 50)
+    # the taxon num grows geometrically from one kingdom to ``leaves`` taxa at the lowest rank
+    sizes = [max(1, int(round(leaves ** (ind / max(1, depth - 1))))) for ind in range(depth)]
+    names = np.array(['%s__%s0' % (LEVEL_PREFIX[0], LEVEL_PREFIX[0])], dtype=object)
+    for prefix, size in zip(LEVEL_PREFIX[1:depth], sizes[1:]):
+        weights = rand.pareto(skew, len(names)) + 1
+        parents = rand.choice(len(names), size=size, p=weights / weights.sum())
+        names = names[parents] + np.array([';%s__%s%d' % (prefix, prefix, ind) for ind in range(size)],
+                                          dtype=object)
+    weights = rand.pareto(skew, len(names)) + 1
+    picked = rand.choice(len(names), size=otus, p=weights / weights.sum())
+    index = pd.Index(['denovo%d' % ind for ind in range(otus)], name='OTU ID')
+    return pd.Series(names[picked], index=index)
+
+
+def make_otu_profile(index, samples, seed=0, density=0.1):
+    """
+    Returns a random otu profile with ``samples`` columns, about ``density`` of the cells are not zero.
+    """
+    import numpy as np
+    import pandas as pd
+    rand = np.random.RandomState(seed)
+    values = rand.random_sample((len(index), samples))
+    values[values > density] = 0
+    columns = ['S%d' % ind for ind in range(samples)]
+    return pd.DataFrame(values, index=index, columns=columns)
+
+
+def write_qiime_files(data_dir, otus, samples, depth=6, skew=1.0, seed=0, density=0.1, chunksize=100000):
+    """
+    Write a synthetic qiime tax_assignment.txt and otu table to ``data_dir``, returns their paths.
+    The files are named by their params, and are kept and reused if they already exist.
+    """
+    tag = 'o%d_s%d_d%d_k%g_r%d' % (otus, samples, depth, skew, seed)
+    if density != 0.1:
+        tag += '_p%g' % density
+    tax_ass = os.path.join(data_dir, 'tax_assignment_%s.txt' % tag)
+    profile = os.path.join(data_dir, 'otu_table_%s.txt' % tag)
+    if os.path.exists(tax_ass) and os.path.exists(profile):
+        return tax_ass, profile
+    tax_lines = make_tax_lines(otus, seed=seed, depth=depth, skew=skew)
+    with open(tax_ass + '.tmp', 'w') as out:
+        for otu, tax_line in zip(tax_lines.index, tax_lines.values):
+            out.write('%s\t%s\t1.0\n' % (otu, tax_line))
+    with open(profile + '.tmp', 'w') as out:
+        for ind, start in enumerate(range(0, otus, chunksize)):
+            chunk = make_otu_profile(tax_lines.index[start:start + chunksize], samples, seed=seed + ind,
+                                     density=density)
+            chunk.to_csv(out, sep='\t', header=ind == 0, float_format='%.6g')
+    os.rename(tax_ass + '.tmp', tax_ass)
+    os.rename(profile + '.tmp', profile)
+    return tax_ass, profile
+
+
+def legacy_get_level_profile(otu_profile, level):
+    import pandas as pd
+    level_profile = otu_profile.loc[level.index]
+    level_profile.index = level
+    result = {}
+    for p in level_profile.index.unique():
+        if level_profile.loc[p].__class__ == pd.DataFrame:
+            s = level_profile.loc[p].sum()
+            s.name = p
+        else:
+            s = level_profile.loc[p]
+        result[p] = s
+    result = pd.DataFrame(result).T
+    return result
+
+
+def bench_level_profile(params):
+    import numpy as np
+    import create_and_plot as cp
+    results = OrderedDict()
+    tax_lines = make_tax_lines(params['otus'], seed=params['seed'])
+    tax_table = cp.parse_tax_lines(tax_lines)
+    tax_table['tax_line'] = tax_lines
+    otu_profile = make_otu_profile(tax_lines.index, params['samples'], seed=params['seed'])
+    level = tax_table['genus'].astype(object)
+    results['legacy_genus'], legacy = timed(legacy_get_level_profile, otu_profile, level)
+    results['genus'], new = timed(cp.get_level_profile, otu_profile, level)
+    results['max_diff'] = float(np.abs(legacy.sort_index().values - new.values).max())
+    results['all_levels'], _ = timed(cp.get_level_profiles, otu_profile, tax_table)
+    return results
+
+
+def legacy_pick_high_abundance(level, otu_profile, top):
+    def filt_fun(n):
+        if n in picked_level:
+            return n
+        else:
+            return float('nan')
+
+    genus_profile = legacy_get_level_profile(otu_profile, level)
+    genus_profile = genus_profile.T.sum()
+    picked_level = genus_profile.sort_values()[:-top - 1:-1].index
+    level = level.map(filt_fun).dropna()
+    return otu_profile.loc[level.index]
+
+
+def bench_pick_high_abundance(params):
+    """
+    Compares the argpartition selection on lineage totals with the sorted genus profile and map filter.
+    """
+    import create_and_plot as cp
+    results = OrderedDict()
+    tax_lines = make_tax_lines(params['otus'], seed=params['seed'], depth=params['depth'], skew=params['skew'])
+    tax_table = cp.parse_tax_lines(tax_lines)
+    tax_table['tax_line'] = tax_lines
+    lineages = tax_table.drop_duplicates('tax_line').set_index('tax_line', drop=False)
+    lineage_profile = cp.get_level_profile(make_otu_profile(tax_lines.index, params['samples'], seed=params['seed']),
+                                           tax_lines)
+    top = max(1, len(lineages['genus'].dropna().unique()) // 10)
+    results['lineages'] = len(lineage_profile)
+    results['top'] = top
+    results['legacy'], legacy = timed(legacy_pick_high_abundance, lineages['genus'].dropna().astype(object),
+                                      lineage_profile, top)
+    results['pick_high_abundance'], new = timed(cp.pick_high_abundance, lineage_profile, lineages,
+                                                cp.parse_prune(None, top))
+    results['same_lineages'] = set(legacy.index) == set(new.index)
+    results['pruned_phylum_3'], pruned = timed(cp.pick_high_abundance, lineage_profile, lineages,
+                                               cp.parse_prune('phylum:3', top))
+    results['pruned_lineages'] = len(pruned)
+    return results
+
+
+def legacy_table_uniform(table):
+    for col_name in table.columns:
+        col = table[col_name]
+        table[col_name] = col.map(lambda s: s / col.sum())
+    return table
+
+
+def bench_table_uniform(params):
+    """
+    Times the broadcast path against the per element one, on a table with a zero sum column,
+    the values are checked in test_create_and_plot.py
+    """
+    import numpy as np
+    import create_and_plot as cp
+    results = OrderedDict()
+    rows = min(max(1, params['otus'] // 50), 1000)
+    index = make_tax_lines(rows, seed=params['seed']).index
+    table = make_otu_profile(index, params['samples'], seed=params['seed'])
+    table.iloc[:, 0] = 0
+    results['rows'] = rows
+    results['legacy'], _ = timed(legacy_table_uniform, table.copy())
+    results['table_uniform'], _ = timed(cp.table_uniform, table)
+    results['float32'], _ = timed(cp.table_uniform, table, dtype=np.float32)
+    return results
+
+
+def bench_read_tax(params):
+    import pandas as pd
+    import create_and_plot as cp
+    results = OrderedDict()
+    tax_lines = make_tax_lines(params['otus'], seed=params['seed'])
+    tax_table = cp.parse_tax_lines(tax_lines)
+    tax_table['tax_line'] = tax_lines
+    profile_dict = pd.Series(1.0, index=pd.unique(tax_table[cp.LEVELS].values.ravel()))
+    results['lineages'] = tax_lines.nunique()
+    results['read_tax'], tree = timed(cp.read_tax, tax_table, profile_dict)
+    results['nodes'] = len(list(tree))
+    return results
+
+
+def bench_newick(params):
+    results = OrderedDict()
+    tree = make_tree(params['nodes'], seed=params['seed'])
+    fd, newick_file = tempfile.mkstemp(suffix='.nwk')
+    try:
+        with os.fdopen(fd, 'w') as out:
+            results['write'], _ = timed(tree.write, out)
+        results['from_newick'], _ = timed(TaxTree.from_newick, newick_file)
+        results['from_newick_mmap'], _ = timed(TaxTree.from_newick, newick_file, use_mmap=True)
+        try:
+            from ete3 import Tree as EteTree
+        except ImportError:
+            results['ete3'] = 'not installed'
+        else:
+            results['ete3'], _ = timed(EteTree, newick_file, format=1)
+    finally:
+        os.remove(newick_file)
+    return results
+
+
+def legacy_pie_percents(total_profile, group):
+    result = {}
+    for name in total_profile.columns:
+        profile_list = total_profile[name].groupby(lambda sample_name: group[sample_name], sort=False).mean()
+        summary = sum(profile_list)
+        result[name] = [s / summary * 100 for s in profile_list]
+    return result
+
+
+def bench_pie_percents(params):
+    """
+    Compares the group matrix product with a groupby mean per leaf.
+    """
+    import numpy as np
+    import create_and_plot as cp
+    results = OrderedDict()
+    leaves = max(1, params['otus'] // 10)
+    index = make_tax_lines(leaves, seed=params['seed']).index
+    total_profile = make_otu_profile(index, params['samples'], seed=params['seed'], density=1).T
+    group = OrderedDict((sample, 'G%d' % (ind % 10)) for ind, sample in enumerate(total_profile.index))
+    results['leaves'] = leaves
+    results['groupby_per_leaf'], legacy = timed(legacy_pie_percents, total_profile, group)
+    results['get_pie_percents'], (_, new) = timed(cp.get_pie_percents, total_profile, group)
+    results['max_diff'] = max(float(np.abs(np.subtract(legacy[name], new[name])).max()) for name in legacy)
+    return results
+
+
+RENDER_MODULES = ['ete3', 'PyQt5', 'PyQt4', 'scipy']
+
+
+def import_time(module):
+    """
+    Import ``module`` in a fresh interpreter, returns the wall time, the cumulative ``-X importtime``
+    in seconds (None before python 3.7) and the render modules it pulled in.
+    """
+    code = 'import sys, %s; sys.stdout.write(",".join(m for m in %r if m in sys.modules))' % (module, RENDER_MODULES)
+    args = [sys.executable]
+    if sys.version_info >= (3, 7):
+        args += ['-X', 'importtime']
+    start = timer()
+    proc = subprocess.Popen(args + ['-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    out, err = proc.communicate()
+    wall = timer() - start
+    if proc.returncode:
+        raise RuntimeError('import %s failed:\n%s' % (module, err))
+    cumulative = None
+    for line in err.splitlines():
+        fields = line.split('|')
+        if line.startswith('import time:') and len(fields) == 3 and fields[2].strip() == module:
+            cumulative = int(fields[1]) / 1e6
+    return wall, cumulative, [m for m in out.split(',') if m]
+
+
+def bench_import_time(params):
+    """
+    Guards that the data modules import without ete3 and Qt, which only the render stage may load.
+    """
+    results = OrderedDict()
+    for module in ('tree', 'cache', 'create_and_plot'):
+        wall, cumulative, loaded = import_time(module)
+        if loaded:
+            raise AssertionError('import %s loads %s' % (module, ', '.join(loaded)))
+        results['%s_wall' % module] = wall
+        results['%s_importtime' % module] = cumulative
+    try:
+        results['ete3_wall'], results['ete3_importtime'], _ = import_time('ete3')
+    except RuntimeError:
+        results['ete3_wall'] = 'not installed'
+    return results
+
+
+def bench_scaling(params):
+    """
+    Runs the data stages of create_and_plot.py, the branch lengths and optionally the render stages
+    on synthetic qiime files of each otu num in ``scales``. Reports the wall time of every stage at
+    each scale, and the slope of log(time) on log(otus), 1 being linear.
+    """
+    import shutil
+    import numpy as np
+    import create_and_plot as cp
+    from stages import Stages
+    results = OrderedDict()
+    data_dir = params['data_dir'] or tempfile.mkdtemp(prefix='newick_plot_bench.')
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    curves = OrderedDict()
+    try:
+        for otus in params['scales']:
+            tax_ass, profile = write_qiime_files(data_dir, otus, params['scale_samples'], depth=params['depth'],
+                                                 skew=params['skew'], seed=params['seed'])
+            outdir = os.path.join(data_dir, 'out_%d' % otus)
+            cp_params = cp.read_params(['--profile', profile, '--tax_ass', tax_ass, '-o', outdir,
+                                        '--top', str(params['top']), '--variants', 'circle_pie'])
+            cp.mkdir(outdir)
+            stages = Stages(detail=True)
+            tree, total_profile = cp.prepare(cp_params, stages)
+            with stages.stage('branch_length') as counts:
+                for node in tree:
+                    node.branch_length
+                counts['nodes'] = len(tree.nodes)
+            if params['render']:
+                with stages.stage('render'):
+                    cp.render_all(tree, total_profile, cp_params, stages)
+            for name, record in stages.records.items():
+                curves.setdefault(name, []).append((otus, record['wall']))
+                results['%s@%d' % (name, otus)] = record['wall']
+            results['nodes@%d' % otus] = len(tree.nodes)
+            peaks = [record['peak_rss'] for record in stages.records.values() if 'peak_rss' in record]
+            if peaks:
+                # the peak of the stages run at this scale, the peak is reset at the start of every stage
+                results['peak_rss@%d' % otus] = max(peaks)
+            else:
+                # the peak of the whole process so far, so it only grows with the scale
+                results['process_peak_rss@%d' % otus] = stages.records['branch_length']['process_peak_rss']
+        for name, points in curves.items():
+            points = [(otus, wall) for otus, wall in points if wall > 0]
+            if len(points) > 1:
+                slope = np.polyfit(np.log([otus for otus, _ in points]), np.log([wall for _, wall in points]), 1)[0]
+                results['%s@slope' % name] = float(slope)
+    finally:
+        if params['data_dir'] is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    return results
+
+
+def peak_memory(fun, *args, **kwargs):
+    """
+    Returns the wall time, the peak bytes traced while running fun and its result,
+    the peak is None where tracemalloc is not available
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        return timed(fun, *args, **kwargs) + (None,)
+    tracemalloc.start()
+    try:
+        wall, result = timed(fun, *args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return wall, result, peak
+
+
+def bench_sparse(params):
+    """
+    Compares the dense and the sparse profile backends on a wide otu table of 0.5% non zero cells,
+    and checks that the uniformed tables, with an empty sample, the mean profiles and the pie percents agree.
+    """
+    import shutil
+    import numpy as np
+    import create_and_plot as cp
+    import sparse_profile
+    results = OrderedDict()
+    table = make_otu_profile(make_tax_lines(1000, seed=params['seed']).index, 50, seed=params['seed'], density=0.05)
+    table.iloc[:, 0] = 0
+    uniformed = sparse_profile.table_uniform(sparse_profile.SparseProfile(table.values, table.index, table.columns))
+    np.testing.assert_allclose(uniformed.to_frame().values, cp.table_uniform(table).values, rtol=1e-12)
+    data_dir = tempfile.mkdtemp(prefix='newick_plot_bench.')
+    try:
+        otus = max(1, params['otus'] // 10)
+        samples = params['samples'] * 4
+        tax_ass, profile = write_qiime_files(data_dir, otus, samples, seed=params['seed'], density=0.005)
+        tax_table = cp.read_tax_table(tax_ass)
+        prune = cp.parse_prune(None, 1000)
+        results['otus'] = otus
+        results['samples'] = samples
+        profiles = {}
+        for name, reader in (('dense', cp.read_profile), ('sparse', cp.read_sparse_profile)):
+            wall, (_, profiles[name]), peak = peak_memory(reader, tax_table, profile, prune)
+            results['%s_time' % name] = wall
+            results['%s_peak_bytes' % name] = peak
+        group = OrderedDict((sample, 'G%d' % (ind % 4)) for ind, sample in enumerate(profiles['dense'].columns))
+        results['dense_mean'], dense_mean = timed(cp.get_mean_profile, profiles['dense'])
+        results['sparse_mean'], sparse_mean = timed(cp.get_mean_profile, profiles['sparse'])
+        results['dense_pie'], (_, dense_pie) = timed(cp.get_pie_percents, profiles['dense'].T, group)
+        results['sparse_pie'], (_, sparse_pie) = timed(
+            profiles['sparse'].pie_percents, cp.get_group_weights(profiles['sparse'].columns, group))
+        results['mean_max_diff'] = float(np.abs(dense_mean - sparse_mean.reindex(dense_mean.index)).max())
+        results['pie_max_diff'] = max(float(np.nanmax(np.abs(np.subtract(dense_pie[name], sparse_pie[name])),
+                                                      initial=0)) for name in dense_pie)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return results
+
+
+def bench_lod(params):
+    """
+    Collapses an adjusted synthetic tree to 500 nodes and to the nodes of at least 0.1%,
+    and checks that the children of every shown node keep the profile total of the full tree.
+    """
+    results = OrderedDict()
+    tree = make_tree(params['nodes'], seed=params['seed'])
+    tree.adjust_profile()
+    results['nodes'] = len(tree.nodes)
+    for name, kwargs in (('max_nodes_500', {'max_nodes': 500}), ('below_0.001', {'min_profile': 0.001})):
+        results[name], (lod_tree, others) = timed(tree.collapse, **kwargs)
+        results['%s_nodes' % name] = len(lod_tree.nodes)
+        results['%s_others' % name] = len(others)
+        diff = 0
+        for node in lod_tree:
+            if node.children and node.name in tree.nodes:
+                full = sum(child.profile for child in tree.nodes[node.name].children)
+                diff = max(diff, abs(sum(child.profile for child in node.children) - full))
+        results['%s_max_diff' % name] = diff
+    return results
+
+
+def node_bytes(tree):
+    """
+    Returns the bytes held by the node objects of ``tree``, their __dict__
+    and their children lists.
+    """
+    total = 0
+    for node in tree:
+        total += sys.getsizeof(node) + sys.getsizeof(node.children)
+        if hasattr(node, '__dict__'):
+            total += sys.getsizeof(node.__dict__)
+    return total
+
+
+def bench_node_memory(params):
+    results = OrderedDict()
+    for name, node_class in (('slots', Node), ('dict', make_dict_node_class())):
+        tree = make_tree(params['nodes'], seed=params['seed'], node_class=node_class)
+        results['%s_nodes' % name] = len(list(tree))
+        results['%s_bytes' % name] = node_bytes(tree)
+    results['ratio'] = results['dict_bytes'] / results['slots_bytes']
+    return results
+
+
+BENCHMARKS = OrderedDict([
+    ('adjust_profile', bench_adjust_profile),
+    ('node_memory', bench_node_memory),
+    ('level_profile', bench_level_profile),
+    ('pick_high_abundance', bench_pick_high_abundance),
+    ('table_uniform', bench_table_uniform),
+    ('read_tax', bench_read_tax),
+    ('newick', bench_newick),
+    ('pie_percents', bench_pie_percents),
+    ('sparse', bench_sparse),
+    ('lod', bench_lod),
+    ('import_time', bench_import_time),
+    ('scaling', bench_scaling),
+])
+
+
+def save_results(results, params, outfile):
+    import json
+    import platform
+    meta = OrderedDict([('python', platform.python_version()), ('platform', platform.platform()),
+                        ('time', time.strftime('%Y-%m-%d %H:%M:%S')), ('params', params)])
+    with open(outfile, 'w') as out:
+        json.dump(OrderedDict([('meta', meta), ('results', results)]), out, indent=2)
+        out.write('\n')
+
+
+def load_results(infile):
+    import json
+    with open(infile) as fp:
+        return json.load(fp)['results']
+
+
+if __name__ == '__main__':
+    params = read_params(sys.argv[1:])
+    old_results = load_results(params['compare']) if params['compare'] else {}
+    results = OrderedDict()
+    for name in params['names']:
+        results[name] = BENCHMARKS[name](params)
+        for key, value in results[name].items():
+            line = [name, key, value]
+            old = old_results.get(name, {}).get(key)
+            if old is not None:
+                line.append(old)
+                if isinstance(value, float) and isinstance(old, (int, float)) and old > 0 and value >= 0:
+                    line.append('%.2fx' % (value / old))
+            print('\t'.join(str(field) for field in line))
+            sys.stdout.flush()
+    if params['save']:
+        save_results(results, params, params['save'])
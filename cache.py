@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*- \#
+"""
+an on disk cache of the parsed tax table, the level profiles and the tax tree,
+keyed by the content of the input files and the params they were made with
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import pandas as pd
+from tree import Tree as TaxTree
+
+CACHE_VERSION = 2
+
+
+def file_sha1(file, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(file, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def dir_size(dirname):
+    return sum(os.path.getsize(os.path.join(path, name))
+               for path, _, names in os.walk(dirname) for name in names)
+
+
+class Cache(object):
+    """
+    Every entry is a directory named by its key, holding:
+        tax_table.pkl  the parsed tax table
+        profile.pkl    the level profiles and the total profile
+        tax_tree.nwk   the adjusted tree, as NHX newick
+
+    The entries are evicted least recently used first once they take more than max_size bytes,
+    an entry is touched whenever it is loaded.
+    """
+
+    def __init__(self, cache_dir, max_size=1 << 30):
+        self.__cache_dir = cache_dir
+        self.__max_size = max_size
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    @property
+    def cache_dir(self):
+        return self.__cache_dir
+
+    @property
+    def max_size(self):
+        return self.__max_size
+
+    def file_hash(self, file):
+        """
+        Returns the sha1 of the content of file. The hashes are remembered by path, size and mtime,
+        so that an unchanged file is only read once.
+        """
+        stat = os.stat(file)
+        stat_key = '%s\t%d\t%r' % (os.path.abspath(file), stat.st_size, stat.st_mtime)
+        index_file = os.path.join(self.__cache_dir, 'hashes.json')
+        try:
+            with open(index_file) as fp:
+                hashes = json.load(fp)
+        except (IOError, ValueError):
+            hashes = {}
+        if stat_key not in hashes:
+            hashes[stat_key] = file_sha1(file)
+            self.__replace(index_file, json.dumps(hashes))
+        return hashes[stat_key]
+
+    def key(self, files, params):
+        """
+        Returns the key of the entry made from files with params, params must be json serializable
+        """
+        sha1 = hashlib.sha1()
+        sha1.update(json.dumps([CACHE_VERSION, [self.file_hash(file) for file in files], params],
+                               sort_keys=True).encode('utf-8'))
+        return sha1.hexdigest()
+
+    def load(self, key):
+        """
+        Returns (tax_table, level_profile, total_profile, tree) of the entry, or None if it is not cached
+        """
+        entry = os.path.join(self.__cache_dir, key)
+        if not os.path.isdir(entry):
+            return None
+        try:
+            tax_table = pd.read_pickle(os.path.join(entry, 'tax_table.pkl'))
+            level_profile, total_profile = pd.read_pickle(os.path.join(entry, 'profile.pkl'))
+            tree = TaxTree.from_newick(os.path.join(entry, 'tax_tree.nwk'))
+        except Exception:
+            # a broken entry is dropped and made again
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+        os.utime(entry, None)
+        return tax_table, level_profile, total_profile, tree
+
+    def store(self, key, tax_table, level_profile, total_profile, tree):
+        entry = os.path.join(self.__cache_dir, key)
+        tmp_dir = tempfile.mkdtemp(prefix='.%s.' % key, dir=self.__cache_dir)
+        try:
+            pd.to_pickle(tax_table, os.path.join(tmp_dir, 'tax_table.pkl'))
+            pd.to_pickle((level_profile, total_profile), os.path.join(tmp_dir, 'profile.pkl'))
+            with open(os.path.join(tmp_dir, 'tax_tree.nwk'), 'w') as out:
+                tree.write(out, nhx=True, dist=True)
+            if not os.path.isdir(entry):
+                os.rename(tmp_dir, entry)
+        except OSError:
+            # another process stored the same entry first
+            if not os.path.isdir(entry):
+                raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_size
+        """
+        entries = []
+        for name in os.listdir(self.__cache_dir):
+            entry = os.path.join(self.__cache_dir, name)
+            if os.path.isdir(entry) and not name.startswith('.'):
+                entries.append((os.path.getmtime(entry), dir_size(entry), entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.__max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def __replace(self, file, content):
+        fd, tmp_file = tempfile.mkstemp(dir=self.__cache_dir)
+        with os.fdopen(fd, 'w') as out:
+            out.write(content)
+        os.rename(tmp_file, file)
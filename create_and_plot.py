@@ -7,18 +7,20 @@ This create newick format from qiime tax assignment file and otu profile
 """
 
 from __future__ import division
-import re
 import sys
 import os
+import csv
 import math
-from ete3 import Tree, TreeStyle, NodeStyle, TextFace, CircleFace, TreeNode, ClusterTree, PieChartFace
+import multiprocessing
 import pandas as pd
 import numpy as np
-import scipy as sp
 import argparse
 from collections import OrderedDict
 from tree import TreeNode as Node
 from tree import Tree as TaxTree
+from cache import Cache, file_sha1
+from incremental import IncrementalState, STATE_VERSION
+from stages import Stages, stage
 
 COLS_BREWER = ['#00447E', '#F34800', '#64A10E', '#930026', '#464E04', '#049a0b', '#4E0C66', '#D00000', '#FF6C00',
                '#FF00FF', '#c7475b', '#00F5FF', '#BDA500', '#A5CFED', '#f0301c', '#2B8BC3', '#FDA100', '#54adf5',
@@ -26,6 +28,15 @@ COLS_BREWER = ['#00447E', '#F34800', '#64A10E', '#930026', '#464E04', '#049a0b',
 
 LEVELS = ['kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
 
+VARIANTS = OrderedDict([
+    ('plain', {'with_branch_circle': False, 'with_leaf_pie': False}),
+    ('circle', {'with_branch_circle': True, 'with_leaf_pie': False}),
+    ('pie', {'with_branch_circle': False, 'with_leaf_pie': True}),
+    ('circle_pie', {'with_branch_circle': True, 'with_leaf_pie': True}),
+])
+
+FORMATS = ['pdf', 'svg', 'png']
+
 COLOR_DICT = OrderedDict()
 for ind, level in enumerate(LEVELS):
     COLOR_DICT[level] = COLS_BREWER[ind % 20]
@@ -40,16 +51,6 @@ TAX_DICT = {
     's': 'species',
 }
 
-SEARCH_REG = {
-    'k': re.compile('(k__[^;]+)'),
-    'p': re.compile('(p__[^;]+)'),
-    'c': re.compile('(c__[^;]+)'),
-    'o': re.compile('(o__[^;]+)'),
-    'f': re.compile('(f__[^;]+)'),
-    'g': re.compile('(g__[^;]+)'),
-    's': re.compile('(s__[^;]+)'),
-}
-
 
 def read_params(args):
     parser = argparse.ArgumentParser(description='plot tax tree| v1.0 at 2015/01/08 by liangzb')
@@ -59,8 +60,16 @@ def read_params(args):
                         help="set the tax_assignment.txt")
     parser.add_argument('-g', '--group_file', dest='group', metavar='FILE', type=str, default=None,
                         help="set the group file if need")
+    parser.add_argument('--group_method', dest='group_method', metavar='STR', type=str, default='mean',
+                        choices=['mean', 'sum'],
+                        help="aggregate the samples of a group by mean or sum, [default is mean]")
     parser.add_argument('--top', dest='top', metavar='INT', type=int, default=20,
                         help="set the top num, [default is 20]")
+    parser.add_argument('--prune', dest='prune', metavar='STR', type=str, default=None,
+                        help="keep only the top taxa at these levels, from the highest down, like phylum:5,genus:20, "
+                             "--top is used for the genus level unless it is given here, [default is genus:top]")
+    parser.add_argument('--chunksize', dest='chunksize', metavar='INT', type=int, default=None,
+                        help="read the profile INT otus at a time, [default is to read it at once]")
     parser.add_argument('-o', '--outdir', dest='outdir', metavar='DIR', type=str, required=True,
                         help="set the outdir")
     parser.add_argument('--with_leaf_pie', dest='with_leaf_pie', action='store_true',
@@ -69,16 +78,99 @@ def read_params(args):
     parser.add_argument('--with_branch_circle', dest='with_branch_circle', action='store_true',
                         help="plot with branch circle, [default is false]")
     parser.set_defaults(with_branch_circle=False)
-
-    args = parser.parse_args()
+    parser.add_argument('--variants', dest='variants', metavar='STR', type=str, default=None,
+                        help="render these comma separated variants of %s from one parsed dataset, "
+                             "[default is the one variant set by --with_leaf_pie and --with_branch_circle]"
+                             % ', '.join(VARIANTS))
+    parser.add_argument('--formats', dest='formats', metavar='STR', type=str, default='pdf',
+                        help="render to these comma separated formats of %s, [default is pdf]" % ', '.join(FORMATS))
+    parser.add_argument('--processes', dest='processes', metavar='INT', type=int, default=1,
+                        help="render the variants in a pool of INT processes, [default is 1]")
+    parser.add_argument('--collapse_below', dest='collapse_below', metavar='FLOAT', type=float, default=0,
+                        help="plot the taxa under this adjusted profile merged into an other node of their parent, "
+                             "the newick keeps every taxon, [default is 0, not to collapse]")
+    parser.add_argument('--max_nodes', dest='max_nodes', metavar='INT', type=int, default=None,
+                        help="plot at most INT taxa, the most abundant ones, the rest merged into other nodes, "
+                             "[default is no limit]")
+    parser.add_argument('--cache_dir', dest='cache_dir', metavar='DIR', type=str, default=None,
+                        help="reuse the parsed tax table, profiles and tree cached in DIR, "
+                             "[default is no cache]")
+    parser.add_argument('--cache_size', dest='cache_size', metavar='INT', type=int, default=1024,
+                        help="evict the least recently used cache entries beyond INT MB, [default is 1024]")
+    parser.add_argument('--sparse', dest='sparse', action='store_true',
+                        help="hold the profiles as sparse matrices, for wide and mostly zero otu tables, "
+                             "the otu table is read --chunksize otus at a time, or 1000 if it is not set, "
+                             "[default is false]")
+    parser.set_defaults(sparse=False)
+    parser.add_argument('--incremental', dest='incremental', metavar='DIR', type=str, default=None,
+                        help="keep the running sums of the study in DIR, and only read the samples of the profile "
+                             "which are not in DIR yet, [default is to read every sample]")
+    parser.add_argument('--profile_stages', '--profile-stages', dest='profile_stages', action='store_true',
+                        help="write the wall time, cpu time, peak rss and counts of every stage "
+                             "to tax_tree_stages.json in the outdir, [default is false]")
+    parser.set_defaults(profile_stages=False)
+    parser.add_argument('--cprofile_stages', dest='cprofile_stages', action='store_true',
+                        help="also dump the cProfile stats of every stage to tax_tree_<stage>.prof in the outdir, "
+                             "[default is false]")
+    parser.set_defaults(cprofile_stages=False)
+    parser.add_argument('--with_modified_tax', dest='with_modified_tax', action='store_true',
+                        help="also write the filled tax_ass_modified.txt to the outdir, [default is false]")
+    parser.set_defaults(with_modified_tax=False)
+    parser.add_argument('--without_newick', dest='without_newick', action='store_true',
+                        help="do not write tax_tree.nwk to the outdir, [default is false]")
+    parser.set_defaults(without_newick=False)
+    parser.add_argument('--without_plot', dest='without_plot', action='store_true',
+                        help="do not render the tree, so ete3 and Qt are never imported, [default is false]")
+    parser.set_defaults(without_plot=False)
+    parser.add_argument('--with_nhx', dest='with_nhx', action='store_true',
+                        help="write dist and the NHX level, profile and size to tax_tree.nwk, [default is false]")
+    parser.set_defaults(with_nhx=False)
+    parser.add_argument('--float32', dest='float32', action='store_true',
+                        help="keep the uniformed profiles in float32 to halve memory, [default is false]")
+    parser.set_defaults(float32=False)
+
+    args = parser.parse_args(args)
     params = vars(args)
+    if params['variants'] is None:
+        params['variants'] = [get_variant(params)]
+    else:
+        params['variants'] = params['variants'].split(',')
+    params['formats'] = params['formats'].split(',')
+    if params['sparse'] and params['incremental'] is not None:
+        parser.error('--sparse can not be used with --incremental')
+    try:
+        params['prune'] = parse_prune(params['prune'], params['top'])
+    except ValueError as e:
+        parser.error(str(e))
+    for variant in params['variants']:
+        if variant not in VARIANTS:
+            parser.error('unknown variant: %s' % variant)
+    for fmt in params['formats']:
+        if fmt not in FORMATS:
+            parser.error('unknown format: %s' % fmt)
     params['group'] = parse_group_file(params['group'])
     return params
 
 
-def table_uniform(table):
-    for col_name, col in table.iteritems():
-        table[col_name] = col.map(lambda s: s / col.sum())
+def get_variant(params):
+    for variant, options in VARIANTS.items():
+        if all(params[key] == value for key, value in options.items()):
+            return variant
+
+
+def table_uniform(table, dtype=None, empty=np.nan):
+    """
+    Divide every column by its sum in one broadcast.
+    Columns summing to zero are filled with ``empty``, NaN by default as 0 / 0 gives,
+    set ``dtype`` (e.g. np.float32) to cast the result.
+    """
+    sums = table.sum()
+    zero = sums == 0
+    table = table.div(sums.where(~zero), axis=1)
+    if zero.any() and not pd.isnull(empty):
+        table.loc[:, zero] = empty
+    if dtype is not None:
+        table = table.astype(dtype)
     return table
 
 
@@ -120,107 +212,310 @@ def float_trans(string):
     return value
 
 
-def get_tax(level=None):
-    def f(string):
-        if level is None:
-            return np.nan
-        try:
-            result = SEARCH_REG[level[0].lower()].search(string).group(1)
-        except AttributeError:
-            return np.nan
-        return result
-
-    return f
-
-
-def get_level_profile(otu_profile, level):
-    level_profile = otu_profile.loc[level.index]
-    level_profile.index = level
+def parse_tax_line(tax_line):
+    """
+    Split a tax line into a dict of level -> tax name, the first name of a level wins
+    """
     result = {}
-    for p in level_profile.index.unique():
-        if level_profile.loc[p].__class__ == pd.DataFrame:
-            s = level_profile.loc[p].sum()
-            s.name = p
-        else:
-            s = level_profile.loc[p]
-        result[p] = s
-    result = pd.DataFrame(result).T
+    for tax_name in tax_line.split(';'):
+        tax_name = tax_name.strip()
+        if len(tax_name) > 3 and tax_name[1:3] == '__' and tax_name[0] in TAX_DICT:
+            result.setdefault(TAX_DICT[tax_name[0]], tax_name)
     return result
 
 
-def pick_high_abundance(level, otu_profile, top):
-    def filt_fun(n):
-        if n in picked_level:
-            return n
-        else:
-            return np.nan
+def parse_tax_lines(tax_line):
+    """
+    Split each tax line into a table with one categorical column per level,
+    every distinct tax line is only split once
+    """
+    unique_lines = pd.Index(tax_line.unique())
+    parsed = pd.DataFrame([parse_tax_line(line) for line in unique_lines], columns=LEVELS)
+    codes = unique_lines.get_indexer(tax_line.values)
+    table = pd.DataFrame(index=tax_line.index)
+    for level in LEVELS:
+        table[level] = pd.Categorical(parsed[level].values.take(codes))
+    return table
 
-    genus_profile = get_level_profile(otu_profile, level)
-    genus_profile = genus_profile.T.sum()
-    picked_level = genus_profile.sort(inplace=False)[:-top - 1:-1].index
-    level = level.map(filt_fun).dropna()
-    return otu_profile.loc[level.index]
 
+def get_compression(file):
+    if file.endswith('.gz'):
+        return 'gzip'
+    return None
 
-def read_profile(tax_ass, profile, top):
-    tax_table = pd.DataFrame.from_csv(tax_ass, sep='\t', header=None)
+
+def read_tax_table(tax_ass, modify=True):
+    """
+    Read the tax assignment file once into a table indexed by otu, with the tax_line,
+    the confidence and one column per level.
+    Every column is read as str, so write_tax_table gives back the otu ids and confidences as they were.
+    With ``modify``, each distinct tax line is filled by modify_tax_line first.
+    """
+    tax_table = pd.read_csv(tax_ass, sep='\t', header=None, index_col=0, quoting=csv.QUOTE_NONE,
+                            dtype=str, keep_default_na=False, compression=get_compression(tax_ass))
     tax_table.columns = pd.Index(['tax_line', 'confidence'])
-    tax_line = tax_table['tax_line']
-    level_dict = {}
-    for level in LEVELS:
-        level_dict[level] = tax_line.map(get_tax(level=level)).dropna()
-    otu_profile = pd.DataFrame.from_csv(profile, sep='\t')
-    otu_profile = pick_high_abundance(level_dict['genus'], otu_profile, top)
+    if modify:
+        tax_line = tax_table['tax_line']
+        unique_lines = tax_line.unique()
+        tax_table['tax_line'] = tax_line.map(dict(zip(unique_lines, map(modify_tax_line, unique_lines))))
+    return pd.concat([tax_table, parse_tax_lines(tax_table['tax_line'])], axis=1)
+
+
+def get_level_profile(otu_profile, level):
+    level = level[level.index.isin(otu_profile.index)]
+    level_profile = otu_profile.loc[level.index]
+    return level_profile.groupby(np.asarray(level)).sum()
+
+
+def get_level_profiles(otu_profile, tax_table):
+    """
+    Sum the otu profile up to every level in LEVELS.
+    The otus are summed by tax line first, so each level only groups the distinct lineages.
+    """
+    tax_table = tax_table[tax_table.index.isin(otu_profile.index)]
+    lineage_profile = get_level_profile(otu_profile, tax_table['tax_line'])
+    lineages = tax_table.drop_duplicates('tax_line').set_index('tax_line')
     level_profile = {}
+    for level in LEVELS:
+        level_profile[level] = get_level_profile(lineage_profile, lineages[level].dropna())
+    return level_profile
+
+
+def get_top(level_total, top):
+    """
+    Returns the index of the ``top`` most abundant taxa of ``level_total``, most abundant first.
+    The top taxa are partitioned out in linear time and only they are sorted.
+    """
+    values = level_total.values
+    if top >= len(values):
+        order = np.argsort(-values, kind='mergesort')
+    else:
+        order = np.argpartition(-values, top - 1)[:top]
+        order = order[np.argsort(-values[order], kind='mergesort')]
+    return level_total.index[order]
+
+
+def parse_prune(prune, top):
+    """
+    Returns the (level, top) list of a prune string like phylum:5,genus:20, from the highest level down.
+    The genus level keeps ``top`` taxa unless the prune string sets it.
+    """
+    levels = OrderedDict()
+    for item in (prune or '').split(','):
+        if not item.strip():
+            continue
+        level, num = item.split(':')
+        level = level.strip()
+        if level not in LEVELS:
+            raise ValueError('unknown level in prune: %s' % level)
+        levels[level] = int(num)
+    levels.setdefault('genus', top)
+    return sorted(levels.items(), key=lambda item: LEVELS.index(item[0]))
+
+
+def select_lineages(lineage_total, lineages, prune):
+    """
+    Returns the lineages kept by ``prune``: at each level, from the highest down, only the lineages of
+    the top taxa among the lineages kept so far are kept, the lineages without a taxon at that level are
+    dropped. ``lineage_total`` is the abundance of each lineage over all samples, so every level is
+    ranked on one vector instead of a full level profile.
+    """
+    for level, top in prune:
+        taxa = np.asarray(lineages[level].reindex(lineage_total.index), dtype=object)
+        picked = get_top(lineage_total.groupby(taxa).sum(), top)
+        lineage_total = lineage_total[pd.Series(taxa).isin(picked).values]
+    return lineage_total.index
+
+
+def pick_high_abundance(lineage_profile, lineages, prune, kept=None):
+    """
+    Keep the lineages of the top taxa at every level of ``prune``, or the ``kept`` lineages if given
+    """
+    if kept is None:
+        kept = select_lineages(lineage_profile.sum(axis=1), lineages, prune)
+    return lineage_profile[lineage_profile.index.isin(kept)]
+
+
+def get_profile_samples(profile):
+    """
+    Returns the sample names in the header of the profile
+    """
+    return list(pd.read_csv(profile, sep='\t', index_col=0, nrows=0, dtype={0: str},
+                            compression=get_compression(profile)).columns)
+
+
+def read_lineage_profile(tax_line, profile, chunksize=None, samples=None):
+    """
+    Read the otu profile and sum the otus by tax line.
+    With ``chunksize``, the profile is streamed that many otus at a time, and the sums of each chunk are
+    added by position into one lineages x samples array allocated up front, every lineage being known
+    from ``tax_line``, so memory is bounded by the lineages rather than the otus. Missing values count as zero.
+    With ``samples``, only the columns of those samples are parsed.
+    The otu ids are read as str, as the tax table reads them, pandas would infer the dtype of each chunk apart.
+    """
+    usecols = None
+    if samples is not None:
+        header = pd.read_csv(profile, sep='\t', nrows=0, compression=get_compression(profile)).columns
+        usecols = [header[0]] + list(samples)
+    reader = pd.read_csv(profile, sep='\t', index_col=0, dtype={0: str}, compression=get_compression(profile),
+                         chunksize=chunksize, usecols=usecols)
+    if chunksize is None:
+        reader = [reader]
+    import scipy.sparse as sp
+    lineage_index = pd.Index(pd.unique(tax_line.dropna().values))
+    seen = np.zeros(len(lineage_index), dtype=bool)
+    sums = None
+    columns = pd.Index([])
+    for chunk in reader:
+        if sums is None:
+            columns = chunk.columns
+            sums = np.zeros((len(lineage_index), len(columns)))
+        codes = lineage_index.get_indexer(tax_line.reindex(chunk.index).values)
+        # the otus out of the tax table are coded -1
+        rows = np.flatnonzero(codes >= 0)
+        lineages, lineage_rows = np.unique(codes[rows], return_inverse=True)
+        # a lineages x otus indicator of the chunk sums it with one sparse product
+        indicator = sp.csr_matrix((np.ones(len(rows)), (lineage_rows, rows)), shape=(len(lineages), len(chunk)))
+        values = chunk.values.astype(float, copy=False)
+        if np.isnan(values).any():
+            values = np.nan_to_num(values)
+        sums[lineages] += indicator.dot(values)
+        seen[lineages] = True
+    if sums is None:
+        sums = np.zeros((len(lineage_index), 0))
+    lineage_profile = pd.DataFrame(sums[seen], index=lineage_index[seen], columns=columns).sort_index()
+    if samples is not None:
+        lineage_profile = lineage_profile[list(samples)]
+    return lineage_profile
+
+
+def get_total_profile(lineage_profile, lineages, dtype=None):
+    """
+    Returns the level profiles of the picked lineage profile, each sample uniformed within each level,
+    and the total profile of all levels
+    """
+    level_profile = get_level_profiles(lineage_profile, lineages)
     total_profile = pd.DataFrame()
     for level in LEVELS:
-        level_profile[level] = get_level_profile(otu_profile, level=level_dict[level]).dropna()
-        level_profile[level] = table_uniform(level_profile[level])
+        level_profile[level] = table_uniform(level_profile[level].dropna(), dtype=dtype)
         total_profile = pd.concat([total_profile, level_profile[level]])
     return level_profile, total_profile
 
 
-def modify_tax_ass(tax_ass, outfile):
-    with open(tax_ass) as fp, open(outfile, 'w') as out:
-        for line in fp:
-            tabs = line.rstrip().split('\t')
-            tax_line = tabs[1]
-            tax_list = tax_line.split(';')
-            for ind, level in enumerate(LEVELS):
-                try:
-                    tax_name = tax_list[ind]
-                except IndexError:
-                    break
-                if level[0] != tax_name[0]:
-                    tax_list.insert(ind, '%s%s_unidentified' % (level[0], tax_name[1:13]))
-            out.write('%s\t%s\t%s\n' % (tabs[0], ';'.join(tax_list), tabs[2]))
+def read_profile(tax_table, profile, prune, dtype=None, chunksize=None, stages=None):
+    with stage(stages, 'read_lineage_profile') as counts:
+        lineage_profile = read_lineage_profile(tax_table['tax_line'], profile, chunksize=chunksize)
+        counts['lineages'], counts['samples'] = lineage_profile.shape
+    lineages = tax_table.drop_duplicates('tax_line').set_index('tax_line', drop=False)
+    with stage(stages, 'pick_high_abundance') as counts:
+        lineage_profile = pick_high_abundance(lineage_profile, lineages, prune)
+        counts['lineages'] = len(lineage_profile)
+    with stage(stages, 'level_profiles') as counts:
+        level_profile, total_profile = get_total_profile(lineage_profile, lineages, dtype=dtype)
+        counts['taxa'] = len(total_profile)
+    return level_profile, total_profile
+
+
+def read_sparse_profile(tax_table, profile, prune, dtype=None, chunksize=None, stages=None):
+    """
+    read_profile on the sparse backend: the otu table is read ``chunksize`` otus at a time into a sparse
+    lineage profile, and every level is aggregated and uniformed without densifying it.
+    The profiles are returned as sparse_profile.SparseProfile.
+    """
+    import sparse_profile
+    with stage(stages, 'read_lineage_profile') as counts:
+        lineage_profile = sparse_profile.read_lineage_profile(tax_table['tax_line'], profile,
+                                                              chunksize=chunksize or 1000,
+                                                              compression=get_compression(profile))
+        counts['lineages'], counts['samples'] = lineage_profile.shape
+        counts['nnz'] = lineage_profile.matrix.nnz
+    lineages = tax_table.drop_duplicates('tax_line').set_index('tax_line', drop=False)
+    with stage(stages, 'pick_high_abundance') as counts:
+        kept = select_lineages(lineage_profile.row_sum(), lineages, prune)
+        lineage_profile = lineage_profile.take_rows(lineage_profile.index.isin(kept))
+        counts['lineages'] = len(lineage_profile)
+    with stage(stages, 'level_profiles') as counts:
+        level_profile = {}
+        for level in LEVELS:
+            level_profile[level] = sparse_profile.table_uniform(
+                sparse_profile.get_level_profile(lineage_profile, lineages[level]), dtype=dtype)
+        total_profile = sparse_profile.SparseProfile.concat([level_profile[level] for level in LEVELS])
+        counts['taxa'] = len(total_profile)
+    return level_profile, total_profile
+
+
+def get_mean_profile(total_profile):
+    """
+    Returns the mean of every taxon over the samples, of a dense or a sparse total profile
+    """
+    if isinstance(total_profile, pd.DataFrame):
+        return total_profile.T.mean()
+    return total_profile.mean_profile()
+
+
+def modify_tax_line(tax_line):
+    """
+    Fill the levels missing in the middle of a tax line with unidentified names
+    """
+    tax_list = tax_line.split(';')
+    for ind, level in enumerate(LEVELS):
+        try:
+            tax_name = tax_list[ind]
+        except IndexError:
+            break
+        if level[0] != tax_name[0]:
+            tax_list.insert(ind, '%s%s_unidentified' % (level[0], tax_name[1:13]))
+    return ';'.join(tax_list)
+
+
+def write_tax_table(tax_table, outfile):
+    with open(outfile, 'w') as out:
+        for otu, tax_line, confidence in tax_table[['tax_line', 'confidence']].itertuples():
+            out.write('%s\t%s\t%s\n' % (otu, tax_line, confidence))
 
 
-def read_tax(tax_ass, profile_dict):
+def read_tax(tax_table, profile_dict):
+    """
+    Build the tax tree from the distinct lineages of the tax table,
+    each taxon gets its node, its parent and its profile exactly once.
+    """
     tree = TaxTree()
-    with open(tax_ass) as fp:
-        for line in fp:
-            tabs = line.rstrip().split('\t')
-            tax_line = tabs[1]
-            tax_list = tax_line.split(';')
-            for ind, tax_name in enumerate(tax_list):
-                if tax_name not in profile_dict:
-                    continue
-                tax_level = TAX_DICT[tax_name[0]]
-                if tax_name not in tree.nodes:
-                    tree.nodes[tax_name] = Node(level=tax_level, name=tax_name)
-                node_present = tree.nodes[tax_name]
-                if ind > 0:
-                    node_previous = tree.nodes[tax_list[ind - 1]]
-                else:
-                    node_previous = tree.root
+    lineages = tax_table.drop_duplicates('tax_line')
+    for tax_list in lineages[LEVELS].itertuples(index=False):
+        node_previous = tree.root
+        for tax_name in tax_list:
+            if pd.isnull(tax_name) or tax_name not in profile_dict:
+                continue
+            if tax_name not in tree.nodes:
+                node_present = Node(level=TAX_DICT[tax_name[0]], name=tax_name)
+                tree.nodes[tax_name] = node_present
                 node_previous.add_child(child=node_present)
-                node_present.profile = profile_dict[node_present.name]
-                node_present.tree = tree
+                node_present.profile = profile_dict[tax_name]
+            node_previous = tree.nodes[tax_name]
     return tree
 
 
+def tax_tree_to_ete(tax_tree):
+    """
+    Convert a tax tree into an ete3 Tree in memory, without writing and parsing newick.
+    Each ete3 node carries the level, profile and size of its tax node,
+    and the tax node itself as the ``source`` feature.
+    """
+    from ete3 import Tree
+    ete_root = Tree(name=tax_tree.root.name, dist=0)
+    to_visit = [(tax_tree.root, ete_root)]
+    while to_visit:
+        node, ete_node = to_visit.pop()
+        ete_node.add_features(level=node.level, profile=node.profile, size=node.size, source=node)
+        if node.style is not None:
+            ete_node.set_style(node.style)
+        for child in node.children:
+            to_visit.append((child, ete_node.add_child(name=child.name, dist=child.dist)))
+    return ete_root
+
+
 def get_tree_style():
+    from ete3 import TreeStyle, TextFace
     ts = TreeStyle()
     # ts.mode = 'c'
     ts.margin_top = 10
@@ -231,6 +526,7 @@ def get_tree_style():
     ts.show_branch_length = False
     ts.show_branch_support = False
     ts.show_scale = False
+    ts.scale = 1
     title = TextFace("     Tax Assignment Tree", fsize=10)
     title.hz_align = 2
     title.vt_align = 2
@@ -240,88 +536,107 @@ def get_tree_style():
     return ts
 
 
-def set_node_default(tree, node_dict):
-    root_node = tree & 'root'
-    for node in tree.traverse():
-        if node is root_node:
-            continue
-        node = node_dict[node.name]
-        nstyle = NodeStyle()
-        node.style = nstyle
-        nstyle["shape"] = "circle"
-        nstyle["hz_line_type"] = 3
-        nstyle["hz_line_color"] = "black"
-        nstyle["hz_line_width"] = 1
-        nstyle["vt_line_color"] = "black"
-        nstyle["vt_line_width"] = 1
-
-
-def add_node_circle(tree, node_dict):
-    root_node = tree & 'root'
-    for node in tree.traverse():
-        if node is root_node:
-            continue
-        nstyle = node_dict[node.name].style
-        nstyle["size"] = node_dict[node.name].size
-        try:
-            nstyle["fgcolor"] = COLOR_DICT[node_dict[node.name].level]
-        except KeyError:
-            nstyle["fgcolor"] = "grey"
-
-
-def add_branch_text(tree, tree_style, node_dict):
-    root_node = tree & 'root'
-    for node in tree.traverse():
-        if node is root_node:
-            continue
-        T1 = TextFace(node.name, ftype="Monaco", fsize=10)
-        T1.hz_align = 0
-        node.add_face(T1, 0, 'branch-top')
-        T2 = TextFace('%s%%' % float_trans(node_dict[node.name].profile * 100), ftype="Monaco", fsize=10)
-        T2.hz_align = 0
-        node.add_face(T2, 0, 'branch-bottom')
-        # print node_dict[node.name].size
-        node.dist = node_dict[node.name].branch_length
-        tree_style.scale = 1
-
-
-def set_node_style(tree, node_dict):
-    root_node = tree & 'root'
-    for node in tree.traverse():
-        if node is root_node:
-            node.set_style(NodeStyle(size=0))
-            continue
-        node.set_style(node_dict[node.name].style)
+def node_default(node):
+    from ete3 import NodeStyle
+    nstyle = NodeStyle()
+    nstyle["shape"] = "circle"
+    nstyle["hz_line_type"] = 3
+    nstyle["hz_line_color"] = "black"
+    nstyle["hz_line_width"] = 1
+    nstyle["vt_line_color"] = "black"
+    nstyle["vt_line_width"] = 1
+    node.set_style(nstyle)
 
 
-def remove_node_circle(tree, node_dict):
-    root_node = tree & 'root'
-    for node in tree.traverse():
-        if node is root_node:
-            continue
-        else:
-            node_dict[node.name].style['size'] = 0
-            node_dict[node.name].min_size = 0
-            node_dict[node.name].size = 0
-
-
-def add_pie_face(tree, ts, total_profile, group):
-    for leaf_name in tree.iter_leaf_names():
-        node = tree & leaf_name
-        profile_list = total_profile[node.name]
-        if group is not None:
-            profile_list_grouped = OrderedDict()
-            for sample_name, profile in profile_list.iteritems():
-                profile_list_grouped[group[sample_name]] = profile
-            profile_list = pd.Series(profile_list_grouped)
-        col_num = len(profile_list)
-        times = int(math.ceil(col_num / len(COLS_BREWER)))
-        cols = (COLS_BREWER * times)[:col_num]
-        summary = sum(profile_list)
-        percents = map(lambda s: s / summary * 100, profile_list)
-        P = PieChartFace(percents=percents, width=50, height=50, colors=cols)
-        node.add_face(P, 0, 'aligned')
-    for ind, g in enumerate(profile_list.index):
+def node_circle(node):
+    nstyle = node.img_style
+    nstyle["size"] = node.size
+    try:
+        nstyle["fgcolor"] = COLOR_DICT[node.level]
+    except KeyError:
+        nstyle["fgcolor"] = "grey"
+
+
+def no_node_circle(node):
+    node.img_style['size'] = 0
+    node.size = 0
+
+
+def branch_text(node):
+    from ete3 import TextFace
+    T1 = TextFace(node.name, ftype="Monaco", fsize=10)
+    T1.hz_align = 0
+    node.add_face(T1, 0, 'branch-top')
+    T2 = TextFace('%s%%' % float_trans(node.profile * 100), ftype="Monaco", fsize=10)
+    T2.hz_align = 0
+    node.add_face(T2, 0, 'branch-bottom')
+    node.dist = node.source.get_branch_length(size=node.size)
+
+
+def get_group_matrix(samples, group):
+    """
+    Returns the samples x groups indicator matrix of ``group``, the groups in order of their first sample,
+    the samples out of ``group`` belong to no group
+    """
+    labels = list(OrderedDict((group[sample_name], None) for sample_name in samples if sample_name in group))
+    columns = dict((g, ind) for ind, g in enumerate(labels))
+    matrix = np.zeros((len(samples), len(labels)))
+    for row, sample_name in enumerate(samples):
+        if sample_name in group:
+            matrix[row, columns[group[sample_name]]] = 1
+    return pd.DataFrame(matrix, index=samples, columns=labels)
+
+
+def get_group_weights(samples, group, method='mean'):
+    """
+    Returns the samples x groups weights aggregating samples into the groups of ``group``,
+    ``method`` is mean or sum
+    """
+    indicator = get_group_matrix(samples, group)
+    if method == 'mean':
+        indicator = indicator / indicator.sum()
+    return indicator
+
+
+def group_profile(total_profile, group, method='mean'):
+    """
+    Aggregate the samples of ``total_profile`` (samples x taxa) into the groups of ``group``,
+    for all taxa with one matrix product, ``method`` is mean or sum
+    """
+    indicator = get_group_weights(total_profile.index, group, method=method)
+    return indicator.T.dot(total_profile.fillna(0))
+
+
+def get_pie_percents(total_profile, group=None, method='mean'):
+    """
+    Returns the pie labels, and a dict of taxon -> percent of each label.
+    The percents of all taxa come from one operation over ``total_profile`` (samples x taxa),
+    with ``group``, the samples are aggregated into groups by ``method`` first.
+    """
+    if group is not None:
+        total_profile = group_profile(total_profile, group, method=method)
+    values = total_profile.values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percents = values / values.sum(axis=0) * 100
+    return list(total_profile.index), dict(zip(total_profile.columns, percents.T.tolist()))
+
+
+def leaf_pie(ts, total_profile, group, method='mean'):
+    """
+    Add the pie legend to ``ts``, and returns a decorator adding the pie chart of each leaf,
+    ``total_profile`` is taxa x samples, dense or sparse
+    """
+    from ete3 import TextFace, CircleFace, PieChartFace
+    if isinstance(total_profile, pd.DataFrame):
+        labels, percents = get_pie_percents(total_profile.T, group=group, method=method)
+    elif group is None:
+        labels, percents = total_profile.pie_percents()
+    else:
+        labels, percents = total_profile.pie_percents(get_group_weights(total_profile.columns, group, method=method))
+    col_num = len(labels)
+    times = int(math.ceil(col_num / len(COLS_BREWER)))
+    cols = (COLS_BREWER * times)[:col_num]
+    for ind, g in enumerate(labels):
         ts.legend.add_face(TextFace(" "), 0)
         ts.legend.add_face(TextFace(" "), 1)
         T = TextFace('  %s  ' % g)
@@ -330,33 +645,283 @@ def add_pie_face(tree, ts, total_profile, group):
         ts.legend.add_face(C, 1)
         ts.legend_position = 1
 
+    def decorator(node):
+        if node.is_leaf():
+            P = PieChartFace(percents=percents[node.name], width=50, height=50, colors=cols)
+            node.add_face(P, 0, 'aligned')
 
-if __name__ == '__main__':
-    params = read_params(sys.argv)
-    mkdir(params['outdir'])
-    modified_tax = '%s/tax_ass_modified.txt' % params['outdir']
-    newick_file = '%s/tax_tree.nwk' % params['outdir']
-    modify_tax_ass(params['tax_ass'], modified_tax)
-    level_profile, total_profile = read_profile(modified_tax, params['profile'], params['top'])
-    tree = read_tax(modified_tax, total_profile.T.mean())
-    tree.adjust_profile()
-    with open(newick_file, 'w') as out:
-        out.write(str(tree))
-    t = Tree(newick_file, format=1)
-    ts = get_tree_style()
-
-    set_node_default(t, node_dict=tree.nodes)
-    suf = ''
+    return decorator
+
+
+def get_decorators(params, ts, total_profile):
+    """
+    Returns the node decorators for the plot options in ``params``, in the order they apply,
+    a new visual option only needs to add its decorator here
+    """
+    decorators = [node_default]
     if params['with_branch_circle']:
-        add_node_circle(t, node_dict=tree.nodes)
-        suf += '_circle'
+        decorators.append(node_circle)
     if params['with_leaf_pie'] and not params['with_branch_circle']:
-        remove_node_circle(t, node_dict=tree.nodes)
+        decorators.append(no_node_circle)
     if params['with_leaf_pie']:
-        add_pie_face(t, ts, total_profile.T, group=params['group'])
+        decorators.append(leaf_pie(ts, total_profile, group=params['group'], method=params['group_method']))
+    decorators.append(branch_text)
+    return decorators
+
+
+def decorate(tree, decorators):
+    """
+    Apply every decorator to each node but the root in a single traversal
+    """
+    from ete3 import NodeStyle
+    tree.set_style(NodeStyle(size=0))
+    for node in tree.iter_descendants():
+        for decorator in decorators:
+            decorator(node)
+
+
+def compute(params, stages=None):
+    """
+    Returns the parsed tax table, the level profiles, the total profile and the adjusted tax tree
+    """
+    with stage(stages, 'read_tax_table') as counts:
+        tax_table = read_tax_table(params['tax_ass'])
+        counts['otus'] = len(tax_table)
+    dtype = np.float32 if params['float32'] else None
+    reader = read_sparse_profile if params['sparse'] else read_profile
+    level_profile, total_profile = reader(tax_table, params['profile'], params['prune'], dtype=dtype,
+                                          chunksize=params['chunksize'], stages=stages)
+    with stage(stages, 'read_tax') as counts:
+        tree = read_tax(tax_table, get_mean_profile(total_profile))
+        counts['nodes'] = len(tree.nodes)
+    with stage(stages, 'adjust_profile'):
+        tree.adjust_profile()
+    return tax_table, level_profile, total_profile, tree
+
+
+def compute_incremental(params, stages=None):
+    """
+    Fold the samples of the profile which the state in params['incremental'] has not seen yet into it.
+
+    The state, see incremental.IncrementalState, keeps the lineage totals behind the pruning, the kept lineages
+    and the running sum and sample count of every taxon. The tax table is written once, and the lineage profile
+    and the total profile of the new samples of every run are written as parts beside it, never rewritten.
+    The new samples are uniformed on their own, as every sample is, and their sums and counts are added to
+    the running ones. If the pruning keeps the same lineages, only the profiles of the existing tree nodes
+    are updated, otherwise the lineage profile parts are merged, and the total profile and the tree are
+    rebuilt from them. The columns of the samples seen before are not read again, so they must not change.
+    """
+    incremental = IncrementalState(params['incremental'])
+    tax_sha1 = file_sha1(params['tax_ass'])
+    key = {'version': STATE_VERSION, 'tax_ass': tax_sha1, 'prune': params['prune'], 'float32': params['float32']}
+    dtype = np.float32 if params['float32'] else None
+    with stage(stages, 'load_state'):
+        state, tax_table, tree = incremental.load(key) or (None, None, None)
+    new_files = OrderedDict()
+    if state is None:
+        with stage(stages, 'read_tax_table') as counts:
+            tax_table = read_tax_table(params['tax_ass'])
+            counts['otus'] = len(tax_table)
+        state = {'key': key, 'generation': 0, 'tax_table': 'tax_table_%s.pkl' % tax_sha1, 'tree': None,
+                 'samples': [], 'lineage_parts': [], 'total_parts': [], 'lineage_total': None, 'kept': None}
+        new_files[state['tax_table']] = tax_table
+    with stage(stages, 'read_lineage_profile') as counts:
+        seen = set(state['samples'])
+        samples = [sample for sample in get_profile_samples(params['profile']) if sample not in seen]
+        counts['samples'] = len(samples)
+        if samples or tree is None:
+            new_profile = read_lineage_profile(tax_table['tax_line'], params['profile'],
+                                               chunksize=params['chunksize'], samples=samples)
+            counts['lineages'] = len(new_profile)
+    if tree is not None and not samples:
+        with stage(stages, 'load_state'):
+            total_profile = incremental.load_parts(state['total_parts'])
+        return tax_table, total_profile, tree
+
+    generation = state['generation'] + 1
+    lineages = tax_table.drop_duplicates('tax_line').set_index('tax_line', drop=False)
+    with stage(stages, 'pick_high_abundance'):
+        lineage_total = new_profile.sum(axis=1)
+        if state['lineage_total'] is not None:
+            lineage_total = state['lineage_total'].add(lineage_total, fill_value=0)
+        kept = select_lineages(lineage_total, lineages, params['prune'])
+    same_top = tree is not None and set(kept) == set(state['kept'])
+    with stage(stages, 'level_profiles') as counts:
+        if same_top:
+            new_level, new_total = get_total_profile(
+                pick_high_abundance(new_profile, lineages, params['prune'], kept), lineages, dtype=dtype)
+            same_top = set(new_total.index) == set(state['profile_sum'].index)
+        if same_top:
+            new_total = new_total.reindex(state['profile_sum'].index)
+            total_parts = state['total_parts'] + ['total_%d.pkl' % generation]
+            total_profile = pd.concat([incremental.load_parts(state['total_parts']), new_total], axis=1)
+            profile_sum = state['profile_sum'] + new_total.T.sum()
+            profile_count = state['profile_count'] + new_total.T.count()
+        else:
+            lineage_profile = new_profile
+            if state['lineage_parts']:
+                # a lineage missing from the otus of a part is zero there
+                lineage_profile = pd.concat([incremental.load_parts(state['lineage_parts']), new_profile],
+                                            axis=1).fillna(0)
+            level_profile, total_profile = get_total_profile(
+                pick_high_abundance(lineage_profile, lineages, params['prune'], kept), lineages, dtype=dtype)
+            new_total = total_profile
+            total_parts = ['total_%d.pkl' % generation]
+            profile_sum = total_profile.T.sum()
+            profile_count = total_profile.T.count()
+        counts['taxa'] = len(total_profile)
+        counts['rebuilt'] = int(not same_top)
+    if same_top:
+        with stage(stages, 'update_tree') as counts:
+            profile_dict = profile_sum / profile_count
+            for name, node in tree.nodes.items():
+                if name != 'root':
+                    node.profile = profile_dict[name]
+            counts['nodes'] = len(tree.nodes)
+    else:
+        with stage(stages, 'read_tax') as counts:
+            tree = read_tax(tax_table, total_profile.T.mean())
+            counts['nodes'] = len(tree.nodes)
+    with stage(stages, 'adjust_profile'):
+        tree.adjust_profile()
+    new_files['lineage_%d.pkl' % generation] = new_profile
+    new_files['total_%d.pkl' % generation] = new_total
+    state.update(generation=generation, tree='tax_tree_%d.nwk' % generation, samples=state['samples'] + samples,
+                 lineage_parts=state['lineage_parts'] + ['lineage_%d.pkl' % generation], total_parts=total_parts,
+                 lineage_total=lineage_total, kept=kept, profile_sum=profile_sum, profile_count=profile_count)
+    with stage(stages, 'save_state'):
+        incremental.save(state, tree, new_files)
+    return tax_table, total_profile, tree
+
+
+def prepare(params, stages=None):
+    """
+    Run the data stages once: returns the adjusted tax tree and the total profile
+    """
+    if params['incremental'] is not None:
+        tax_table, total_profile, tree = compute_incremental(params, stages)
+    elif params['cache_dir'] is None:
+        tax_table, level_profile, total_profile, tree = compute(params, stages)
+    else:
+        cache = Cache(params['cache_dir'], max_size=params['cache_size'] << 20)
+        with stage(stages, 'cache_load') as counts:
+            key = cache.key([params['tax_ass'], params['profile']],
+                            {'prune': params['prune'], 'float32': params['float32'], 'sparse': params['sparse']})
+            cached = cache.load(key)
+            counts['hits'] = int(cached is not None)
+        if cached is None:
+            tax_table, level_profile, total_profile, tree = compute(params, stages)
+            with stage(stages, 'cache_store'):
+                cache.store(key, tax_table, level_profile, total_profile, tree)
+        else:
+            tax_table, level_profile, total_profile, tree = cached
+    if params['with_modified_tax']:
+        write_tax_table(tax_table, '%s/tax_ass_modified.txt' % params['outdir'])
+    if not params['without_newick']:
+        with stage(stages, 'write_newick'):
+            with open('%s/tax_tree.nwk' % params['outdir'], 'w') as out:
+                tree.write(out, nhx=params['with_nhx'], dist=params['with_nhx'])
+    return tree, total_profile
+
+
+def add_other_profiles(total_profile, others):
+    """
+    Returns the total profile with a row for every other node, the sum of the rows merged into it
+    """
+    if not isinstance(total_profile, pd.DataFrame):
+        return total_profile.add_sum_rows(others)
+    rows = pd.DataFrame([total_profile.loc[names].sum() for names in others.values()], index=list(others))
+    return pd.concat([total_profile, rows])
+
+
+def collapse_tree(tree, total_profile, params):
+    """
+    Returns the tree collapsed to the level of detail set by --collapse_below and --max_nodes,
+    and the total profile with the profiles of its other nodes, for their pies
+    """
+    tree, others = tree.collapse(min_profile=params['collapse_below'], max_nodes=params['max_nodes'])
+    if others:
+        total_profile = add_other_profiles(total_profile, others)
+    return tree, total_profile
+
+
+def render(tree, total_profile, params, variant, stages=None):
+    """
+    Render one variant of the tree to every format in params, returns the output files
+    """
+    variant_params = dict(params, **VARIANTS[variant])
+    with stage(stages, 'tax_tree_to_ete') as counts:
+        t = tax_tree_to_ete(tree)
+        counts['nodes'] = len(tree.nodes)
+    with stage(stages, 'decorate'):
+        ts = get_tree_style()
+        decorate(t, get_decorators(variant_params, ts, total_profile))
+    suf = ''
+    if variant_params['with_branch_circle']:
+        suf += '_circle'
+    if variant_params['with_leaf_pie']:
         suf += '_pie'
-    add_branch_text(t, tree_style=ts, node_dict=tree.nodes)
-    set_node_style(t, node_dict=tree.nodes)
+    out_files = []
+    for fmt in params['formats']:
+        out_file = '%s/tax_tree%s.%s' % (params['outdir'], suf, fmt)
+        with stage(stages, 'draw') as counts:
+            t.render(out_file, tree_style=ts, dpi=100)
+            counts['files'] = 1
+        out_files.append(out_file)
+    return out_files
+
+
+_render_state = None
+
+
+def _init_render(tree, total_profile, params):
+    global _render_state
+    _render_state = (tree, total_profile, params)
+
 
-    pdf_file = '%s/tax_tree%s.pdf' % (params['outdir'], suf)
-    t.render(pdf_file, tree_style=ts, dpi=100)
+def _render_variant(variant):
+    tree, total_profile, params = _render_state
+    return render(tree, total_profile, params, variant)
+
+
+def render_all(tree, total_profile, params, stages=None):
+    """
+    Render every variant in params from the same tree and profile,
+    in a pool of params['processes'] processes if more than one,
+    the stages of each variant are only recorded when rendered in this process
+    """
+    if params['processes'] <= 1 or len(params['variants']) <= 1:
+        return [render(tree, total_profile, params, variant, stages) for variant in params['variants']]
+    pool = multiprocessing.Pool(min(params['processes'], len(params['variants'])),
+                                initializer=_init_render, initargs=(tree, total_profile, params))
+    try:
+        return pool.map(_render_variant, params['variants'])
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run(params):
+    """
+    Plot one profile and tax_ass pair, returns the wall time of every stage
+    """
+    mkdir(params['outdir'])
+    cprofile_prefix = '%s/tax_tree_' % params['outdir'] if params['cprofile_stages'] else None
+    stages = Stages(detail=params['profile_stages'], cprofile_prefix=cprofile_prefix)
+    tree, total_profile = prepare(params, stages)
+    if not params['without_plot']:
+        if params['collapse_below'] or params['max_nodes'] is not None:
+            with stage(stages, 'collapse') as counts:
+                tree, total_profile = collapse_tree(tree, total_profile, params)
+                counts['nodes'] = len(tree.nodes)
+        with stage(stages, 'render') as counts:
+            render_all(tree, total_profile, params, stages)
+            counts['variants'] = len(params['variants'])
+    if params['profile_stages']:
+        stages.write_json('%s/tax_tree_stages.json' % params['outdir'])
+    return stages.timings()
+
+
+if __name__ == '__main__':
+    params = read_params(sys.argv[1:])
+    run(params)
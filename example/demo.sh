@@ -1,3 +1,2 @@
 ../create_and_plot.py --profile otu_table_uniform.txt --tax_ass tax_assignment.txt -g group.txt -o $PWD --with_leaf_pie
-../create_and_plot.py --profile otu_table_uniform.txt --tax_ass tax_assignment.txt -o $PWD --with_branch_circle 
-../create_and_plot.py --profile otu_table_uniform.txt --tax_ass tax_assignment.txt -o $PWD --with_leaf_pie --with_branch_circle
+../create_and_plot.py --profile otu_table_uniform.txt --tax_ass tax_assignment.txt -o $PWD --variants circle,circle_pie
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*- \#
+"""
+the incremental state of a study on disk, the running sums of the samples plotted so far,
+so that a later run only reads the samples which are new
+"""
+
+import os
+import re
+import tempfile
+import pandas as pd
+from tree import Tree as TaxTree
+
+STATE_VERSION = 2
+
+STATE_FILE_REG = re.compile(r'^(tax_table_[0-9a-f]+\.pkl|lineage_\d+\.pkl|total_\d+\.pkl|tax_tree_\d+\.nwk)$')
+
+
+class IncrementalState(object):
+    """
+    The state directory holds:
+        state.pkl               the state: its key, the samples, the lineage totals behind the pruning,
+                                the kept lineages, the running sum and sample count of every taxon,
+                                and the names of the files below it refers to
+        tax_table_<sha1>.pkl    the parsed tax table, named by the sha1 of the tax_ass
+        lineage_<n>.pkl         the lineage profile of the samples new in run n
+        total_<n>.pkl           the total profile of the samples new in run n,
+                                or of every sample if the tree was rebuilt in run n
+        tax_tree_<n>.nwk        the adjusted tree of run n, as NHX newick
+
+    Every file is written to a temporary name and renamed, the files of a run under new names,
+    and state.pkl last, so a crash at any point leaves the last state and the files it refers to whole.
+    """
+
+    def __init__(self, state_dir):
+        self.__state_dir = state_dir
+
+    @property
+    def state_dir(self):
+        return self.__state_dir
+
+    def load(self, key):
+        """
+        Returns (state, tax_table, tree), or None if there is no state, or if it was made with another key.
+        A broken state is dropped, to be made again.
+        """
+        state_file = os.path.join(self.__state_dir, 'state.pkl')
+        if not os.path.exists(state_file):
+            return None
+        try:
+            state = pd.read_pickle(state_file)
+            if state.get('key') != key:
+                return None
+            for name in state['lineage_parts'] + state['total_parts']:
+                if not os.path.exists(os.path.join(self.__state_dir, name)):
+                    raise IOError('missing state file: %s' % name)
+            tax_table = pd.read_pickle(os.path.join(self.__state_dir, state['tax_table']))
+            tree = TaxTree.from_newick(os.path.join(self.__state_dir, state['tree']))
+        except Exception:
+            self.drop()
+            return None
+        return state, tax_table, tree
+
+    def load_parts(self, names):
+        """
+        Returns the profiles of the state files ``names`` side by side
+        """
+        return pd.concat([pd.read_pickle(os.path.join(self.__state_dir, name)) for name in names], axis=1)
+
+    def save(self, state, tree, new_files):
+        """
+        Write ``new_files``, a dict of name -> table, and the tree, then replace state.pkl.
+        The files which the state does not refer to any more are removed last.
+        """
+        if not os.path.isdir(self.__state_dir):
+            os.makedirs(self.__state_dir)
+        for name, table in new_files.items():
+            self.__write(name, lambda out: pd.to_pickle(table, out))
+        self.__write(state['tree'], lambda out: self.__write_tree(tree, out))
+        self.__write('state.pkl', lambda out: pd.to_pickle(state, out))
+        referred = set([state['tax_table'], state['tree']] + state['lineage_parts'] + state['total_parts'])
+        for name in os.listdir(self.__state_dir):
+            if STATE_FILE_REG.match(name) and name not in referred:
+                os.remove(os.path.join(self.__state_dir, name))
+
+    def drop(self):
+        """
+        Remove state.pkl and every file of the state
+        """
+        for name in os.listdir(self.__state_dir):
+            if name == 'state.pkl' or STATE_FILE_REG.match(name):
+                os.remove(os.path.join(self.__state_dir, name))
+
+    @staticmethod
+    def __write_tree(tree, outfile):
+        with open(outfile, 'w') as out:
+            tree.write(out, nhx=True, dist=True)
+
+    def __write(self, name, write):
+        fd, tmp_file = tempfile.mkstemp(prefix='.%s.' % name, dir=self.__state_dir)
+        os.close(fd)
+        try:
+            write(tmp_file)
+            os.rename(tmp_file, os.path.join(self.__state_dir, name))
+        except Exception:
+            os.remove(tmp_file)
+            raise
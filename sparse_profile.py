@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*- \#
+"""
+a sparse backend of the profiles, for wide and mostly zero otu tables
+"""
+
+from __future__ import division
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+class SparseProfile(object):
+    """
+    A taxa x samples profile held as a scipy CSR matrix, labeled like a DataFrame.
+    A sample missing at a level, because it sums to zero there, is stored as explicit NaN.
+    """
+
+    def __init__(self, matrix, index, columns):
+        self.__matrix = sp.csr_matrix(matrix)
+        self.__index = pd.Index(index)
+        self.__columns = pd.Index(columns)
+
+    def __len__(self):
+        return self.__matrix.shape[0]
+
+    @property
+    def matrix(self):
+        return self.__matrix
+
+    @property
+    def index(self):
+        return self.__index
+
+    @property
+    def columns(self):
+        return self.__columns
+
+    @property
+    def shape(self):
+        return self.__matrix.shape
+
+    def __filled_matrix(self):
+        """
+        Returns the matrix with its NaN as zero
+        """
+        data = self.__matrix.data
+        return sp.csr_matrix((np.where(np.isnan(data), 0, data), self.__matrix.indices, self.__matrix.indptr),
+                             shape=self.shape)
+
+    def take_rows(self, mask):
+        """
+        Returns a new profile of the rows where ``mask`` is True
+        """
+        rows = np.flatnonzero(mask)
+        return SparseProfile(self.__matrix[rows], self.__index[rows], self.__columns)
+
+    def row_sum(self):
+        """
+        Returns the sum of every row over the samples, skipping NaN
+        """
+        matrix = self.__filled_matrix()
+        return pd.Series(np.asarray(matrix.sum(axis=1)).ravel(), index=self.__index)
+
+    def mean_profile(self):
+        """
+        Returns the mean of every row over the samples, skipping NaN, as total_profile.T.mean() does
+        """
+        nan = np.isnan(self.__matrix.data).astype(float)
+        nan_count = sp.csr_matrix((nan, self.__matrix.indices, self.__matrix.indptr), shape=self.shape).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.row_sum() / (self.shape[1] - np.asarray(nan_count).ravel())
+
+    def pie_percents(self, group_matrix=None):
+        """
+        Returns the pie labels, and a dict of taxon -> percent of each label.
+        With ``group_matrix`` (samples x groups), the samples are aggregated into its weighted groups,
+        with one sparse product for all taxa, NaN counting as zero.
+        """
+        if group_matrix is None:
+            labels = list(self.__columns)
+            sums = np.asarray(self.__matrix.sum(axis=1)).ravel()
+            percents = self.__matrix.copy()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                percents.data = percents.data / np.repeat(sums, np.diff(percents.indptr)) * 100
+            rows = (percents[ind].toarray().ravel().tolist() for ind in range(len(self)))
+            return labels, dict(zip(self.__index, rows))
+        matrix = self.__filled_matrix()
+        values = np.asarray(matrix.dot(group_matrix.reindex(self.__columns).values))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percents = values / values.sum(axis=1)[:, None] * 100
+        return list(group_matrix.columns), dict(zip(self.__index, percents.tolist()))
+
+    def add_sum_rows(self, groups):
+        """
+        Returns a new profile with a row appended for every name -> row names of ``groups``,
+        the sum of those rows with NaN counting as zero, all made with one sparse product
+        """
+        positions = self.__index.get_indexer([name for names in groups.values() for name in names])
+        codes = np.repeat(np.arange(len(groups)), [len(names) for names in groups.values()])
+        indicator = sp.csr_matrix((np.ones(len(positions)), (codes, positions)), shape=(len(groups), len(self)))
+        matrix = self.__filled_matrix()
+        rows = SparseProfile(indicator.dot(matrix), list(groups), self.__columns)
+        return SparseProfile.concat([self, rows])
+
+    def to_frame(self):
+        return pd.DataFrame(self.__matrix.toarray(), index=self.__index, columns=self.__columns)
+
+    @classmethod
+    def concat(cls, profiles):
+        """
+        Stack the rows of profiles with the same samples
+        """
+        return cls(sp.vstack([profile.matrix for profile in profiles], format='csr'),
+                   np.concatenate([np.asarray(profile.index, dtype=object) for profile in profiles]),
+                   profiles[0].columns)
+
+
+def read_lineage_profile(tax_line, profile, chunksize=1000, compression=None):
+    """
+    Read the otu profile into a sparse lineages x samples profile, ``chunksize`` otus at a time.
+    Each chunk is summed by tax line with one sparse product of a lineage x otu indicator,
+    so only the chunk is ever dense, and the sums of all chunks are added up once at the end.
+    The otu ids are read as str, as the tax table reads them.
+    """
+    lineage_index = pd.Index(pd.unique(tax_line.dropna().values))
+    reader = pd.read_csv(profile, sep='\t', index_col=0, dtype={0: str}, compression=compression, chunksize=chunksize)
+    # the triplets of the lineage sums of every chunk, summed into one CSR matrix at the end
+    rows, cols, data = [], [], []
+    seen = np.zeros(len(lineage_index), dtype=bool)
+    columns = None
+    for chunk in reader:
+        columns = chunk.columns
+        codes = lineage_index.get_indexer(tax_line.reindex(chunk.index).values)
+        otus = np.flatnonzero(codes >= 0)
+        lineages, lineage_rows = np.unique(codes[otus], return_inverse=True)
+        seen[lineages] = True
+        indicator = sp.csr_matrix((np.ones(len(otus)), (lineage_rows, otus)), shape=(len(lineages), len(chunk)))
+        chunk_matrix = indicator.dot(sp.csr_matrix(chunk.values)).tocoo()
+        rows.append(lineages[chunk_matrix.row])
+        cols.append(chunk_matrix.col)
+        data.append(chunk_matrix.data)
+    if columns is None:
+        return SparseProfile(sp.csr_matrix((0, 0)), [], [])
+    lineage_matrix = sp.coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                                   shape=(len(lineage_index), len(columns))).tocsr()
+    return SparseProfile(lineage_matrix, lineage_index, columns).take_rows(seen)
+
+
+def get_level_profile(lineage_profile, level):
+    """
+    Sum the lineages into the taxa of ``level`` (lineage -> taxon) with one sparse product,
+    the taxa sorted as groupby sorts them, the lineages without a taxon are dropped
+    """
+    taxa = np.asarray(level.reindex(lineage_profile.index), dtype=object)
+    codes, uniques = pd.factorize(taxa, sort=True)
+    rows = np.flatnonzero(codes >= 0)
+    indicator = sp.csr_matrix((np.ones(len(rows)), (codes[rows], rows)), shape=(len(uniques), len(lineage_profile)))
+    return SparseProfile(indicator.dot(lineage_profile.matrix), uniques, lineage_profile.columns)
+
+
+def table_uniform(profile, dtype=None):
+    """
+    Divide every column by its sum in place of the stored values,
+    the columns which sum to zero become NaN, as table_uniform does them
+    """
+    matrix = profile.matrix.tocsc()
+    if dtype is not None:
+        matrix = matrix.astype(dtype)
+    sums = np.asarray(matrix.sum(axis=0)).ravel()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        matrix.data /= np.repeat(sums, np.diff(matrix.indptr)).astype(matrix.dtype)
+    empty = np.flatnonzero(sums == 0)
+    if len(empty) and len(profile):
+        rows = len(profile)
+        nan = sp.csc_matrix((np.full(rows * len(empty), np.nan, dtype=matrix.dtype),
+                             (np.tile(np.arange(rows), len(empty)), np.repeat(empty, rows))), shape=matrix.shape)
+        # the stored values of an empty column are 0 / 0 already, the others are filled in
+        matrix = matrix + nan
+    return SparseProfile(matrix, profile.index, profile.columns)
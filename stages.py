@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*- \#
+"""
+wall time, cpu time, peak rss and counts of the pipeline stages
+"""
+
+from __future__ import division
+import os
+import sys
+import time
+import json
+from contextlib import contextmanager
+from timeit import default_timer as timer
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def cpu_time():
+    """
+    Returns the user and system cpu time of this process
+    """
+    if hasattr(time, 'process_time'):
+        return time.process_time()
+    times = os.times()
+    return times[0] + times[1]
+
+
+CLEAR_REFS = '/proc/self/clear_refs'
+PROC_STATUS = '/proc/self/status'
+
+
+def process_peak_rss():
+    """
+    Returns the peak resident set size of this process since it started in bytes, or None where it is not known
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on mac os, kilobytes elsewhere
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of this process to its current size, returns False where it can not be,
+    which is everywhere but linux
+    """
+    try:
+        with open(CLEAR_REFS, 'w') as out:
+            out.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of this process since the last reset_peak_rss in bytes
+    """
+    with open(PROC_STATUS) as fp:
+        for line in fp:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+class Stages(object):
+    """
+    Records the stages run in this process. A stage run more than once, such as the decoration
+    of every variant, adds up its times and counts.
+
+    :argument False detail: also record the cpu time and the peak rss of each stage, the peak rss being
+       the most of all its runs. The peak is reset at the start of every stage on linux, elsewhere only
+       the peak of the whole process at the end of the stage is known, and recorded as process_peak_rss.
+    :argument None cprofile_prefix: dump the cProfile stats of each stage to <cprofile_prefix><stage>.prof,
+       a stage nested in a profiled stage is only part of the outer dump.
+    """
+
+    def __init__(self, detail=False, cprofile_prefix=None):
+        self.__detail = detail
+        self.__cprofile_prefix = cprofile_prefix
+        self.__profiling = False
+        self.__records = OrderedDict()
+        # the peak rss of the running stages, innermost last
+        self.__peaks = []
+        self.__resettable = detail and reset_peak_rss()
+
+    @property
+    def records(self):
+        return self.__records
+
+    def __fold_peak_rss(self):
+        """
+        Fold the peak rss since the last reset into every running stage, and reset it
+        """
+        peak = peak_rss()
+        self.__peaks = [max(running, peak) for running in self.__peaks]
+        reset_peak_rss()
+
+    def timings(self):
+        """
+        Returns an OrderedDict of stage -> wall time
+        """
+        return OrderedDict((name, record['wall']) for name, record in self.__records.items())
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Record the with block as stage ``name``, the block may add counts to the yielded dict
+        """
+        record = self.__records.setdefault(name, OrderedDict([('wall', 0), ('calls', 0)]))
+        counts = OrderedDict()
+        profiler = None
+        if self.__cprofile_prefix is not None and not self.__profiling:
+            import cProfile
+            profiler = cProfile.Profile()
+            self.__profiling = True
+            profiler.enable()
+        start_cpu = None
+        if self.__detail:
+            start_cpu = cpu_time()
+            if self.__resettable:
+                self.__fold_peak_rss()
+                self.__peaks.append(0)
+        start = timer()
+        try:
+            yield counts
+        finally:
+            record['wall'] += timer() - start
+            record['calls'] += 1
+            if self.__detail:
+                record['cpu'] = record.get('cpu', 0) + cpu_time() - start_cpu
+                if self.__resettable:
+                    self.__fold_peak_rss()
+                    record['peak_rss'] = max(record.get('peak_rss', 0), self.__peaks.pop())
+                else:
+                    record['process_peak_rss'] = process_peak_rss()
+            if profiler is not None:
+                profiler.disable()
+                self.__profiling = False
+                profiler.dump_stats('%s%s.prof' % (self.__cprofile_prefix, name))
+            for key, value in counts.items():
+                record[key] = record.get(key, 0) + value
+
+    def write_json(self, outfile):
+        with open(outfile, 'w') as out:
+            json.dump(self.__records, out, indent=2)
+            out.write('\n')
+
+
+@contextmanager
+def stage(stages, name):
+    """
+    Record the with block in ``stages`` if it is not None, yields the dict of counts either way
+    """
+    if stages is None:
+        yield {}
+    else:
+        with stages.stage(name) as counts:
+            yield counts
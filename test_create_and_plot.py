@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*- \#
+"""
+regression tests of create_and_plot.py, run with python -m unittest test_create_and_plot
+"""
+
+import unittest
+import numpy as np
+import pandas as pd
+import create_and_plot as cp
+
+
+class TableUniformTest(unittest.TestCase):
+    def setUp(self):
+        self.table = pd.DataFrame({'s1': [1.0, 3.0], 's2': [0.0, 0.0], 's3': [2.0, 2.0]}, index=['a', 'b'],
+                                  columns=['s1', 's2', 's3'])
+
+    def test_zero_column_is_nan(self):
+        expected = np.array([[0.25, np.nan, 0.5],
+                             [0.75, np.nan, 0.5]])
+        result = cp.table_uniform(self.table)
+        np.testing.assert_array_equal(result.values, expected)
+        self.assertEqual(list(result.index), ['a', 'b'])
+        self.assertEqual(list(result.columns), ['s1', 's2', 's3'])
+
+    def test_zero_column_is_empty(self):
+        expected = np.array([[0.25, 0, 0.5],
+                             [0.75, 0, 0.5]])
+        np.testing.assert_array_equal(cp.table_uniform(self.table, empty=0).values, expected)
+
+    def test_float32(self):
+        expected = np.array([[0.25, np.nan, 0.5],
+                             [0.75, np.nan, 0.5]], dtype=np.float32)
+        result = cp.table_uniform(self.table, dtype=np.float32)
+        self.assertTrue((result.dtypes == np.float32).all())
+        np.testing.assert_array_equal(result.values, expected)
+
+    def test_table_is_not_modified(self):
+        cp.table_uniform(self.table)
+        np.testing.assert_array_equal(self.table.values, [[1.0, 0.0, 2.0], [3.0, 0.0, 2.0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,45 +6,314 @@
 a tree data structure, referenced from ete3
 """
 
-from collections import defaultdict, deque
-from ete3 import NodeStyle
-from ete3.coretype.tree import TreeError
+import os
+import re
+import mmap
+import heapq
+import itertools
+from collections import defaultdict, deque, OrderedDict
+
+
+class TreeError(Exception):
+    pass
+
+
+NEWICK_QUOTE_REG = re.compile(r"[(),:;\[\]']")
+
+# a label starts with a non space character, so the spaces between the tokens are never a label
+NEWICK_TOKEN_REG = re.compile(br"\s*(?:'((?:[^']|'')*)'|\[([^\]]*)\]|([(),:;])|([^(),:;\[\]'\s][^(),:;\[\]']*))")
+
+
+def quote_name(name):
+    """
+    Quote a node name for newick if it holds a character newick reserves
+    """
+    if NEWICK_QUOTE_REG.search(name):
+        return "'%s'" % name.replace("'", "''")
+    return name
+
+
+def parse_nhx(comment):
+    """
+    Returns a dict of the attributes in a NHX comment like ``&&NHX:level=genus:profile=0.1``
+    """
+    attrs = {}
+    if comment.startswith('&&NHX'):
+        for item in comment.split(':')[1:]:
+            key, _, value = item.partition('=')
+            attrs[key] = value
+    return attrs
 
 
 class Tree(object):
+    @classmethod
+    def from_newick(cls, newick, use_mmap=False, level_fn=None, is_string=False):
+        """
+        Load a tree from a newick file, or from a newick string with ``is_string``,
+        in one pass over the tokens. Quoted names are unquoted, branch lengths are restored
+        into dist, the NHX level, profile and size into the node properties.
+
+        :argument False use_mmap: memory map the file instead of reading it in, an empty file is read.
+        :argument None level_fn: a function giving the level of a node from its name,
+           used for the nodes without a NHX level.
+        :argument False is_string: ``newick`` is the newick string itself rather than a file.
+        """
+        if is_string:
+            data = newick.encode('utf-8')
+        else:
+            with open(newick, 'rb') as fp:
+                if use_mmap and os.fstat(fp.fileno()).st_size:
+                    data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    data = fp.read()
+
+        nodes = []
+        parents = []
+        attrs = defaultdict(dict)
+
+        def new_node():
+            if nodes and not parents:
+                raise TreeError('More than one root in the newick %s' % ('string' if is_string else newick))
+            child = TreeNode('')
+            if parents:
+                parents[-1].children.append(child)
+                child.up = parents[-1]
+            nodes.append(child)
+            return child
+
+        node = None
+        in_dist = False
+        for match in NEWICK_TOKEN_REG.finditer(data):
+            quoted, comment, punct, label = match.groups()
+            if punct is not None and punct != b':':
+                # a branch length left empty, as in A:,B
+                in_dist = False
+            if punct == b'(':
+                parents.append(new_node())
+                node = None
+            elif punct == b')':
+                if not parents:
+                    raise TreeError('Unbalanced parentheses in the newick %s' % ('string' if is_string else newick))
+                node = parents.pop()
+            elif punct == b',':
+                node = None
+            elif punct == b':':
+                in_dist = True
+            elif punct == b';':
+                break
+            else:
+                if node is None:
+                    node = new_node()
+                if comment is not None:
+                    attrs[node].update(parse_nhx(comment.decode('utf-8')))
+                elif in_dist:
+                    dist = (label if label is not None else quoted).strip()
+                    try:
+                        float(dist)
+                    except ValueError:
+                        raise TreeError('Branch length %r of %r is not a number' % (dist.decode('utf-8'), node.name))
+                    attrs[node]['dist'] = dist
+                    in_dist = False
+                elif quoted is not None:
+                    node.name = quoted.decode('utf-8').replace("''", "'")
+                else:
+                    node.name = label.strip().decode('utf-8')
+        if isinstance(data, mmap.mmap):
+            data.close()
+        if not nodes:
+            raise TreeError('No tree in the newick %s' % ('string' if is_string else newick))
+
+        if level_fn is not None:
+            for node in nodes:
+                node.level = level_fn(node.name)
+        for node, node_attrs in attrs.items():
+            if 'level' in node_attrs:
+                node.level = node_attrs['level']
+            if 'profile' in node_attrs:
+                node.profile = float(node_attrs['profile'])
+            if 'size' in node_attrs:
+                node.size = node_attrs['size']
+            if 'dist' in node_attrs:
+                node.dist = node_attrs['dist']
+        root = nodes[0]
+        if root.level is None:
+            root.level = 'root'
+        tree = cls(root=root)
+        for node in nodes[1:]:
+            tree.nodes[node.name] = node
+        return tree
+
     def __init__(self, root=None):
         if root is None:
             self.__root_node = TreeNode('root', level='root')
         else:
             self.__root_node = root
-        self.__root_node.tree = self
+        self.__levels = defaultdict(OrderedDict)
+        self.__max_dist = {}
+        for node in self.__root_node.traverse():
+            node.tree = self
         self.nodes = defaultdict(TreeNode)
         self.nodes['root'] = self.root
 
     def __str__(self):
-        return str(self.root) + ';'
+        return self.write()
+
+    def write(self, out=None, nhx=False, dist=False):
+        """
+        Write the tree in newick format, see ``TreeNode.write``.
+        """
+        if out is None:
+            return self.root.write(nhx=nhx, dist=dist) + ';'
+        self.root.write(out, nhx=nhx, dist=dist)
+        out.write(';')
 
     def __iter__(self):
         for node in self.root.traverse():
             yield node
 
     def iter_level(self, level):
-        for node in self.root.traverse():
-            if node.level == level:
-                yield node
+        """
+        Iterate over the nodes of ``level``, in the order they joined the tree.
+        """
+        for node in self.__levels.get(level, ()):
+            yield node
 
     def get_level(self, level):
         return [node for node in self.iter_level(level)]
 
-    def adjust_profile(self):
+    def get_max_dist(self, level):
+        """
+        Returns the max dist of the nodes in ``level``, or None if the level is empty.
+        The value is cached and only rescanned after the max node shrinks.
+        """
+        if level not in self.__max_dist:
+            nodes = self.__levels.get(level)
+            if not nodes:
+                return None
+            self.__max_dist[level] = max(node.dist for node in nodes)
+        return self.__max_dist[level]
+
+    def _add_to_index(self, node):
+        self.__levels[node.level][node] = None
+        max_dist = self.__max_dist.get(node.level)
+        if max_dist is not None and node.dist > max_dist:
+            self.__max_dist[node.level] = node.dist
+
+    def _remove_from_index(self, node, level):
+        nodes = self.__levels.get(level)
+        if nodes is not None and node in nodes:
+            del nodes[node]
+            self.__max_dist.pop(level, None)
+
+    def _update_dist(self, node, old, new):
+        max_dist = self.__max_dist.get(node.level)
+        if max_dist is None:
+            return
+        if new >= max_dist:
+            self.__max_dist[node.level] = new
+        elif old >= max_dist:
+            del self.__max_dist[node.level]
+
+    def adjust_profile(self, refresh=True):
+        """
+        Rescale the profile of every node which has sisters into its share of
+        the sisters' total, multiplied by the profile of its parent.
+
+        Parents are swept from the root down and the sisters' total is summed
+        once per parent, then kept up to date while the sisters are rescaled
+        one after another, so the result is the same as rescaling each node
+        against the current profiles of its sisters.
+
+        :argument True refresh: if False, only the profile values are written,
+           size and dist are left as they are until ``refresh_profile`` is called.
+        """
+        for parent in self.root.traverse():
+            children = parent.children
+            if len(children) < 2:
+                continue
+            total = sum(child.profile for child in children)
+            for child in children:
+                profile = child.profile
+                percent = profile / total
+                if parent.profile:
+                    percent *= parent.profile
+                child.set_profile(percent, refresh=refresh)
+                total += percent - profile
+
+    def refresh_profile(self):
+        """
+        Recompute size and dist of every node but the root from its profile.
+        """
         for node in self:
-            if not node.get_sisters():
+            if node is not self.root:
+                node.set_profile(node.profile)
+
+    def get_lod_nodes(self, min_profile=0, max_nodes=None):
+        """
+        Returns the set of nodes shown at a level of detail: the nodes with a profile of at least
+        ``min_profile`` under shown parents, and of those at most ``max_nodes``, the most abundant first.
+        The root is always shown.
+        """
+        shown = set([self.root])
+        heap = []
+        counter = itertools.count()
+
+        def push_children(node):
+            for child in node.children:
+                if child.profile >= min_profile:
+                    heapq.heappush(heap, (-child.profile, next(counter), child))
+
+        push_children(self.root)
+        while heap and (max_nodes is None or len(shown) <= max_nodes):
+            node = heapq.heappop(heap)[2]
+            shown.add(node)
+            push_children(node)
+        return shown
+
+    def collapse(self, min_profile=0, max_nodes=None, other_name='other %s'):
+        """
+        Returns a copy of the tree at a level of detail, see ``get_lod_nodes``, and a dict of
+        other node name -> the names of the nodes merged into it.
+
+        The tree is traversed with an ``is_leaf_fn`` which stops at the hidden nodes, so a hidden
+        subtree is never visited. A shown node whose children are all hidden becomes a leaf, without an other
+        node, its profile already covers them. The hidden children of a node are merged into one other node named
+        ``other_name % parent.name``, with the sum of their profiles, a single hidden child is kept as a leaf.
+
+        :argument 0 min_profile: hide the nodes under this profile, profiles being adjusted by ``adjust_profile``.
+        :argument None max_nodes: show at most this many nodes but the root and the other nodes.
+        """
+        shown = self.get_lod_nodes(min_profile=min_profile, max_nodes=max_nodes)
+        root = TreeNode(self.root.name, level=self.root.level)
+        tree = self.__class__(root=root)
+        copies = {self.root: root}
+        hidden = OrderedDict()
+
+        def copy_node(node, parent):
+            copy = parent.add_child(TreeNode(node.name, level=node.level))
+            copy.profile = node.profile
+            tree.nodes[copy.name] = copy
+            return copy
+
+        for node in self.root.traverse('preorder', is_leaf_fn=lambda n: n not in shown):
+            if node is self.root:
                 continue
-            percent = node.profile / sum(map(lambda s: s.profile, node.get_sisters(include=True)))
-            if node.up.profile:
-                node.profile = percent * node.up.profile
+            if node in shown:
+                copies[node] = copy_node(node, copies[node.up])
             else:
-                node.profile = percent
+                hidden.setdefault(node.up, []).append(node)
+        others = OrderedDict()
+        for parent, nodes in hidden.items():
+            if len(nodes) == len(parent.children) and parent is not self.root:
+                continue
+            if len(nodes) == 1:
+                copy_node(nodes[0], copies[parent])
+                continue
+            other = copies[parent].add_child(TreeNode(other_name % parent.name, level=nodes[0].level))
+            other.profile = sum(node.profile for node in nodes)
+            tree.nodes[other.name] = other
+            others[other.name] = [node.name for node in nodes]
+        return tree, others
 
     @property
     def root(self):
@@ -53,6 +322,8 @@ class Tree(object):
 
 class TreeNode(object):
     MIN_SIZE = 5
+    __slots__ = ('name', 'up', 'children', '__min_size', '__style', '__level',
+                 '__profile', '__dist', '__size', '__tree')
 
     def _iter_descendants_postorder(self, is_leaf_fn=None):
         to_visit = [self]
@@ -115,14 +386,56 @@ class TreeNode(object):
         self.__tree = None
 
     def __str__(self):
-        if self.children:
-            result = '('
-            result += ','.join(map(str, self.children))
-            result += ')%s' % self.name
-        else:
-            result = self.name
+        return self.write()
 
-        return result
+    def _iter_newick(self, nhx=False, dist=False):
+        """
+        Iterate over the newick pieces of the subtree under this node, without recursion.
+        """
+        to_visit = [self]
+        while to_visit:
+            node = to_visit.pop(-1)
+            if isinstance(node, tuple):
+                # POSTORDER ACTIONS and separators
+                text, node = node
+                yield text
+                if node is None:
+                    continue
+            elif node.children:
+                # PREORDER ACTIONS
+                yield '('
+                to_visit.append((')', node))
+                for ind, child in enumerate(reversed(node.children)):
+                    if ind:
+                        to_visit.append((',', None))
+                    to_visit.append(child)
+                continue
+            yield node._get_newick_label(nhx=nhx, dist=dist)
+
+    def _get_newick_label(self, nhx=False, dist=False):
+        label = quote_name(self.name)
+        if dist:
+            label += ':%r' % float(self.dist)
+        if nhx:
+            label += '[&&NHX'
+            if self.level is not None:
+                label += ':level=%s' % self.level
+            label += ':profile=%r:size=%r]' % (float(self.profile), float(self.size))
+        return label
+
+    def write(self, out=None, nhx=False, dist=False):
+        """
+        Write the subtree under this node in newick format, piece by piece.
+
+        :argument None out: a file object to stream into, if None the newick is returned as a string.
+        :argument False nhx: also write level, profile and size as NHX attributes.
+        :argument False dist: also write dist as branch length.
+        """
+        pieces = self._iter_newick(nhx=nhx, dist=dist)
+        if out is None:
+            return ''.join(pieces)
+        for piece in pieces:
+            out.write(piece)
 
     # Topology management
     def add_child(self, child=None, name=None, level=None):
@@ -143,9 +456,13 @@ class TreeNode(object):
             child.name = name
         if level is not None:
             child.level = level
-        if child not in self.children:
+        # a node without parent is in no children list, which saves the scan on wide nodes
+        if child.up is None or child not in self.children:
             self.children.append(child)
         child.up = self
+        if self.tree is not None and child.tree is not self.tree:
+            for node in child.traverse():
+                node.tree = self.tree
         return child
 
     def add_sister(self, sister=None, name=None, level=None):
@@ -183,11 +500,9 @@ class TreeNode(object):
             return []
 
     def get_same_level(self):
-        same_level = []
-        for node in self.tree:
-            if node.level == self.level:
-                same_level.append(node)
-        return same_level
+        if self.tree is None:
+            return []
+        return self.tree.get_level(self.level)
 
     def is_leaf(self):
         """
@@ -212,7 +527,8 @@ class TreeNode(object):
 
     @style.setter
     def style(self, value):
-        if isinstance(value, NodeStyle):
+        # any dict of style options, an ete3 NodeStyle is a dict
+        if isinstance(value, dict):
             self.__style = value
 
     @property
@@ -221,8 +537,11 @@ class TreeNode(object):
 
     @tree.setter
     def tree(self, t):
-        if isinstance(t, Tree):
+        if isinstance(t, Tree) and t is not self.__tree:
+            if self.__tree is not None:
+                self.__tree._remove_from_index(self, self.level)
             self.__tree = t
+            t._add_to_index(self)
 
     @property
     def level(self):
@@ -230,7 +549,11 @@ class TreeNode(object):
 
     @level.setter
     def level(self, value):
+        if self.__tree is not None:
+            self.__tree._remove_from_index(self, self.__level)
         self.__level = value
+        if self.__tree is not None:
+            self.__tree._add_to_index(self)
 
     @property
     def profile(self):
@@ -238,9 +561,16 @@ class TreeNode(object):
 
     @profile.setter
     def profile(self, value):
+        self.set_profile(value)
+
+    def set_profile(self, value, refresh=True):
+        """
+        Set the profile, and recompute size and dist from it unless ``refresh`` is False.
+        """
         self.__profile = value
-        self.size = self.profile ** 0.5 * 50
-        self.__dist = len(self.name) * 7 + self.size + 4
+        if refresh:
+            self.size = self.profile ** 0.5 * 50
+            self._set_dist(len(self.name) * 7 + self.size + 4)
 
     @property
     def size(self):
@@ -262,19 +592,30 @@ class TreeNode(object):
     @dist.setter
     def dist(self, value):
         try:
-            self.__dist = float(value)
+            self._set_dist(float(value))
         except ValueError:
             pass
 
+    def _set_dist(self, value):
+        old, self.__dist = self.__dist, value
+        if self.__tree is not None:
+            self.__tree._update_dist(self, old, value)
+
     @property
     def branch_length(self):
-        def f(node):
-            return node.dist
+        return self.get_branch_length()
 
-        level_dists = map(f, self.get_same_level())
-        if level_dists:
-            max_dist = max(level_dists)
-            return max_dist - self.size
+    def get_branch_length(self, size=None):
+        """
+        Returns the max dist of the level minus ``size``, the size of this node by default.
+        """
+        max_dist = None
+        if self.tree is not None:
+            max_dist = self.tree.get_max_dist(self.level)
+        if max_dist is not None:
+            if size is None:
+                size = self.size
+            return max_dist - size
         return self.dist
 
     def traverse(self, strategy="levelorder", is_leaf_fn=None):